@@ -0,0 +1,157 @@
+# Benchmarks for the poem generation pipeline, stage by stage, on the bundled corpora and on scaled up copies of
+# them. Needs NLTK but no microphone, speakers, network or Arduino; run from the repository, e.g.
+#   python bench.py --scales 1 10 --poems 20 --output bench_results.json --compare last_results.json
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import generator
+
+bench_sources = ['poe_all.txt', 'shakespeare.txt']
+bench_scales = [1, 10, 100]                 # synthetic corpora: the source this many times over
+bench_poems = 20                            # poems generated per corpus, cycling through the poem types
+regression_threshold = 0.2                  # slower by more than this fraction counts as a regression
+regression_min_seconds = 0.005              # stages faster than this are timer noise, never regressions
+stages = ['text_build', 'model_load', 'grammar', 'frame', 'add_collocations', 'add_big_words', 'repeat_nouns',
+          'add_context_words', 'add_first_unfilled', 'fill_remaining']
+
+
+class Bench:
+
+    # the source itself for scale 1, otherwise a file with scale copies of it; every copy has its lines shuffled
+    # so the same words turn up in new neighbourhoods instead of repeating one text word for word
+    def corpus(source, scale, directory):
+        if scale == 1:
+            return source
+        with open(source, encoding='utf-8') as file:
+            lines = file.read().splitlines()
+        shuffle = random.Random(scale)
+        name, extension = os.path.splitext(os.path.basename(source))
+        path = os.path.join(directory, '{}.x{}{}'.format(name, scale, extension))
+        with open(path, 'w', encoding='utf-8') as file:
+            for i in range(scale):
+                shuffle.shuffle(lines)
+                file.write('\n'.join(lines) + '\n')
+        return path
+
+    # run one stage and add its time, or with memory=True its tracemalloc peak, to stats[stage]
+    def timed(stats, stage, memory, function, *args):
+        if memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - started
+        entry = stats.setdefault(stage, {'seconds': 0.0, 'calls': 0, 'peak_bytes': 0})
+        entry['seconds'] += seconds
+        entry['calls'] += 1
+        if memory:
+            entry['peak_bytes'] = max(entry['peak_bytes'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        return result
+
+    # the stages of Generator.generate_lines on the whole frame at once instead of line by line
+    def generate(stats, memory, text, length, haiku):
+        form = 'haiku' if haiku else 'free_form'  # parse and compile the grammar file like a cold start does
+        cached = os.path.join(generator.model_cache_dir, form + '.grammar')
+        if os.path.exists(cached):
+            os.remove(cached)
+        grammar = Bench.timed(stats, 'grammar', memory, generator.Grammar, haiku)
+        frame = Bench.timed(stats, 'frame', memory, generator.Frame, grammar, text.tags, length, haiku)
+        Bench.timed(stats, 'add_collocations', memory, frame.add_collocations, text)
+        Bench.timed(stats, 'add_big_words', memory, frame.add_big_words, text)
+        Bench.timed(stats, 'repeat_nouns', memory, frame.repeat_nouns, length)
+        for x in range(3):
+            Bench.timed(stats, 'add_context_words', memory, frame.add_context_words, text)
+        Bench.timed(stats, 'add_first_unfilled', memory, frame.add_first_unfilled, text)
+        Bench.timed(stats, 'add_context_words', memory, frame.add_context_words, text)
+        Bench.timed(stats, 'fill_remaining', memory, frame.fill_remaining, text)
+        return frame.text_lines()
+
+    def run_corpus(path, poems, memory):
+        stats = {}
+        key = generator.Text.file_key(path)
+        random.seed(0)
+        # the build Text.load would run: in one go for small sources, chunked on a process pool for large ones
+        text = Bench.timed(stats, 'text_build', memory, generator.Text.build_source, path, key)
+        generator.ModelCache.save(generator.Text.model_path(path), key, text)
+        Bench.timed(stats, 'model_load', memory, generator.Text.load, path)
+        types = list(generator.poem_types.values())
+        for i in range(poems):
+            length, haiku = types[i % len(types)]
+            Bench.generate(stats, memory, text, length, haiku)
+        return stats, len(text.token_ids)
+
+    # time every stage in one pass and measure its peak memory in a second one, tracemalloc slows everything down
+    def run(sources, scales, poems, directory):
+        results = []
+        for source in sources:
+            for scale in scales:
+                path = Bench.corpus(source, scale, directory)
+                timings, tokens = Bench.run_corpus(path, poems, False)
+                memory, tokens = Bench.run_corpus(path, poems, True)
+                for stage in stages:
+                    if stage not in timings:
+                        continue
+                    results.append({'corpus': source, 'scale': scale, 'tokens': tokens, 'stage': stage,
+                                    'seconds': timings[stage]['seconds'], 'calls': timings[stage]['calls'],
+                                    'peak_bytes': memory[stage]['peak_bytes']})
+                    Bench.print_result(results[-1])
+        return results
+
+    def print_result(result):
+        print('{corpus:>16} x{scale:<4} {stage:>18} {seconds:10.4f}s {calls:6d} calls {peak:10.1f} KiB'.format(
+            peak=result['peak_bytes'] / 1024, **result))
+
+    # stages that got slower than previous results by more than the threshold
+    def compare(results, previous, threshold=regression_threshold):
+        before = {(r['corpus'], r['scale'], r['stage']): r for r in previous['results']}
+        regressions = []
+        for result in results:
+            old = before.get((result['corpus'], result['scale'], result['stage']))
+            if old is None or max(old['seconds'], result['seconds']) < regression_min_seconds:
+                continue
+            ratio = result['seconds'] / old['seconds']
+            if ratio > 1 + threshold:
+                regressions.append((result, ratio))
+                print('Regression: {} x{} {} {:.2f}x slower ({:.4f}s -> {:.4f}s)'.format(
+                    result['corpus'], result['scale'], result['stage'], ratio, old['seconds'], result['seconds']))
+        return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time every stage of poem generation.')
+    parser.add_argument('--sources', nargs='+', default=bench_sources)
+    parser.add_argument('--scales', nargs='+', type=int, default=bench_scales)
+    parser.add_argument('--poems', type=int, default=bench_poems)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run, regressions make the exit status 1')
+    args = parser.parse_args()
+    output = args.output and os.path.abspath(args.output)
+    compare = args.compare and os.path.abspath(args.compare)
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    directory = tempfile.mkdtemp(prefix='poetry_bench_')
+    generator.model_cache_dir = directory  # never touch the real model cache
+    try:
+        results = Bench.run(args.sources, args.scales, args.poems, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+              'machine': platform.machine(), 'nltk': generator.ModelCache.package_version('nltk'),
+              'model_version': generator.model_version, 'poems': args.poems, 'results': results}
+    if output:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=1)
+    if compare:
+        with open(compare) as file:
+            previous = json.load(file)
+        if Bench.compare(results, previous):
+            sys.exit(1)
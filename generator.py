@@ -0,0 +1,1321 @@
+# Poetry generator core: corpus models, grammars and poem frames. Importing this module needs neither NLTK nor
+# any of the box hardware; NLTK is imported the first time a corpus or grammar actually has to be built.
+import random
+import re
+import sys
+import os
+import hashlib
+import pickle
+import threading
+import collections
+import bisect
+import itertools
+import multiprocessing
+import importlib
+import importlib.metadata
+import json
+import mmap
+import time
+from array import array
+from instrumentation import metrics
+
+
+# stands in for an object that is only created on first attribute access
+class Lazy:
+
+    def __init__(self, create):
+        self.create = create
+        self.instance = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.instance is None:
+                self.instance = self.create()
+        return self.instance
+
+    def __getattr__(self, name):
+        if name in ('create', 'instance', 'lock'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def module(name):
+        return Lazy(lambda: importlib.import_module(name))
+
+
+# Generator Natural Langugae Tool Kit
+nltk = Lazy.module('nltk')
+nltk_metrics = Lazy.module('nltk.metrics')  # the nltk.metrics attribute is nltk.translate.metrics after nltk's imports
+
+model_cache_dir = 'corpus_cache'            # precompiled corpus models, one per source text
+model_version = 8                           # bump when the layout of Text changes
+tagger_version = 'averaged_perceptron_tagger'
+collocation_measures = ('likelihood_ratio', 'pmi', 'chi_sq')  # BigramAssocMeasures kept ready in every model
+collocation_count = 40                      # best collocations kept per measure
+collocation_min_freq = 3
+ignored_words = None                        # stopwords as a set, loaded on first use
+big_word_length = 7                         # big words: at least this long and seen more than big_word_min_count times
+big_word_min_count = 2
+corpus_sources = ['poe_all.txt', 'shakespeare.txt', 'bible.txt', 'recording_audio_temp.txt']  # preload order
+corpus_blends = {'blend': [('poe_all.txt', 7), ('recording_audio_temp.txt', 3)]}  # name -> (source, weight) mixes
+corpus_memory_budget = 256 * 1024 * 1024    # bytes of corpus models kept warm in memory
+grammar_dir = 'grammars'                    # one .cfg file per poem form
+grammar_version = 1                         # bump when the compiled grammar layout changes
+compiled_grammars = {}                      # (form, mtime, size) -> Grammar, filled on first use
+poem_types = {'haiku': (3, True), 'short': (4, False), 'medium': (8, False), 'long': (12, False)}  # length, haiku
+batch_models = {}                           # source -> Text of generate_batch, mapped by each batch worker
+poem_pool_size = 3                          # ready made poems kept per source and poem type
+poem_pool_retry_seconds = 30                # pause after a failed refill, e.g. NLTK data missing
+source_chunk_size = 1 << 20                 # characters read at a time when a source is cleaned or hashed
+cleaned_sources = ('bible.txt',)            # sources run through Text.clean_chunks before they are tagged
+stream_build_size = 2 * 1024 * 1024         # sources from this many bytes on are built chunk by chunk, see Text.build
+build_processes = max(1, (os.cpu_count() or 1) - 1)  # tagging processes for chunked builds
+# process pools never fork the box: a forked child keeps every lock another thread held at that moment, e.g. Lazy.lock
+# while the poem pool tags a word, and waits on it forever
+pool_start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+build_checkpoint_seconds = 30               # a chunked build saves its progress this often and resumes from it
+sentence_ends = ('. ', '.\n', '! ', '!\n', '? ', '?\n')
+mapped_format = b'POEMAP01'                # first bytes of a memory mapped model, bump with the layout
+frame_line_max_depth = 8                    # past this depth only productions that cannot recurse are expanded
+
+# source cleaning in one pass: the rules that look at more than one character are one regex, run first and
+# allowing for the characters the single character rules delete; those are one translation table. The regex
+# covers a line break before indentation, a possessive 's and an em dash before a space, hyphen or line break,
+# each also across the digits, _, : and indented line breaks the old chained substitutions removed first
+clean_pattern = re.compile("\n[0-9]* |'(?:[0-9_:]|\n[0-9]* )*s|"
+                           "—(?:[0-9_:]|\n[0-9]* |'(?:[0-9_:]|\n[0-9]* )*s)*(?:[ -]|\n(?![0-9]* ))")
+clean_tail = re.compile("[\n'][0-9_:\n ]*\\Z|—[0-9_:\n 's]*\\Z")  # a clean_pattern match cut off by the chunk end
+clean_table = str.maketrans({**dict.fromkeys('0123456789_:"'), **dict.fromkeys('\n-.?!', ' ')})
+
+
+# pickled models in model_cache_dir, each stored with the key of the source it was built from
+class ModelCache:
+
+    def load(path, key):
+        try:
+            with open(path, 'rb') as model_file:
+                cached = pickle.load(model_file)
+            if cached['key'] == key:
+                metrics.count('model_cache', kind=os.path.splitext(path)[1][1:], result='hit')
+                return cached['value']
+        except (OSError, EOFError, KeyError, AttributeError, ImportError, pickle.UnpicklingError):
+            pass  # missing or stale model
+        metrics.count('model_cache', kind=os.path.splitext(path)[1][1:], result='miss')
+        return None
+
+    # installed version of a package without importing it
+    def package_version(name):
+        try:
+            return importlib.metadata.version(name)
+        except Exception:
+            return 'unknown'
+
+    def save(path, key, value):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as model_file:
+            pickle.dump({'key': key, 'value': value}, model_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)  # never leave a half written model behind
+
+
+class Text:
+    def __init__(self, raw_text):
+        tagged_text_array = nltk.pos_tag(nltk.word_tokenize(raw_text))
+        self.tags = list(nltk.data.load('help/tagsets/upenn_tagset.pickle'))
+        self.tag_index = {tag: i for i, tag in enumerate(self.tags)}
+        self.vocab = []               # word id -> word, every token and its lowercase form
+        self.word_ids = {}            # word -> word id
+        self.lower_ids = array('i')   # word id -> id of its lowercase form
+        self.token_ids = array('i')   # the corpus as word ids
+        self.tag_ids = array('B')     # tag index of every token
+        self.add_tagged(tagged_text_array)
+        self.compact()
+
+    # append tagged tokens to the corpus, compact() builds the lookup arrays from them
+    def add_tagged(self, tagged):
+        for word, tag in tagged:
+            self.token_ids.append(self.intern(word))
+            self.tag_ids.append(self.tag_id(tag))
+
+    def intern(self, word):
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            word_id = len(self.vocab)
+            self.vocab.append(word)
+            self.word_ids[word] = word_id
+            self.lower_ids.append(word_id)
+            lower = word.lower()
+            if lower != word:
+                self.lower_ids[word_id] = self.intern(lower)
+        return word_id
+
+    def tag_id(self, tag):
+        if tag not in self.tag_index:
+            self.tag_index[tag] = len(self.tags)
+            self.tags.append(tag)
+        return self.tag_index[tag]
+
+    # build the id indexed lookup arrays from the token and tag sequences
+    def compact(self):
+        vocab_size = len(self.vocab)
+        self.word_counts = array('i', bytes(4 * vocab_size))
+        for word_id in self.token_ids:
+            self.word_counts[word_id] += 1
+        self.before_offsets, self.before_ids, self.before_tags = Text.neighbour_index(self.token_ids, self.tag_ids, vocab_size, -1)
+        self.after_offsets, self.after_ids, self.after_tags = Text.neighbour_index(self.token_ids, self.tag_ids, vocab_size, 1)
+
+        # most frequent corpus tag of every word, lowercase only forms take the tag of their other forms
+        self.word_tags = array('B', [255]) * vocab_size
+        best = {}
+        for word_counts in (collections.Counter(zip(self.token_ids, self.tag_ids)),
+                            collections.Counter(zip((self.lower_ids[word_id] for word_id in self.token_ids), self.tag_ids))):
+            own_words = set(best)
+            for (word_id, tag_id), count in word_counts.items():
+                if word_id not in own_words and count > best.get(word_id, (0, 0))[0]:
+                    best[word_id] = (count, tag_id)
+        for word_id, (count, tag_id) in best.items():
+            self.word_tags[word_id] = tag_id
+
+        # POS buckets: lowercase word ids per tag with cumulative counts for weighted draws
+        counts = collections.Counter(zip(self.tag_ids, (self.lower_ids[word_id] for word_id in self.token_ids)))
+        self.bucket_offsets = array('i', bytes(4 * (len(self.tags) + 1)))
+        self.bucket_ids = array('i')
+        self.bucket_weights = array('i')
+        previous_tag, total = None, 0
+        for (tag_id, word_id), count in sorted(counts.items()):
+            if tag_id != previous_tag:
+                previous_tag, total = tag_id, 0
+            total += count
+            self.bucket_ids.append(word_id)
+            self.bucket_weights.append(total)
+            self.bucket_offsets[tag_id + 1] += 1
+        for tag_id in range(len(self.tags)):
+            self.bucket_offsets[tag_id + 1] += self.bucket_offsets[tag_id]
+
+        self.index_big_words()
+
+        # bigram counts for collocations, only pairs of words that can be part of one
+        self.bigram_counts = collections.Counter()
+        for i in range(len(self.token_ids) - 1):
+            self.count_bigram(self.token_ids[i], self.token_ids[i + 1])
+        self.collocations = {measure: self.find_collocations(measure) for measure in collocation_measures}
+
+        # text added by extend() since the last compact
+        self.pending_before = {}      # word id -> [(tag id, neighbour id)]
+        self.pending_after = {}
+        self.pending_buckets = {}     # tag id -> Counter of lowercase word ids
+        self.pending_totals = {}      # tag id -> number of pending bucket entries
+
+    # CSR style neighbour table: neighbours of word id w are ids[offsets[w]:offsets[w + 1]], with the tag each
+    # neighbour had in that position in tags[...]; a slice is sorted by that tag, then by corpus order
+    def neighbour_index(token_ids, tag_ids, vocab_size, step):
+        positions = range(1, len(token_ids)) if step < 0 else range(len(token_ids) - 1)
+        offsets = array('i', bytes(4 * (vocab_size + 1)))
+        for i in positions:
+            offsets[token_ids[i] + 1] += 1
+        for word_id in range(vocab_size):
+            offsets[word_id + 1] += offsets[word_id]
+        next_slot = array('i', offsets)
+        ids = array('i', bytes(4 * offsets[-1]))
+        tags = array('B', bytes(offsets[-1]))
+        for i in sorted(positions, key=lambda i: tag_ids[i + step]):
+            word_id = token_ids[i]
+            ids[next_slot[word_id]] = token_ids[i + step]
+            tags[next_slot[word_id]] = tag_ids[i + step]
+            next_slot[word_id] += 1
+        return offsets, ids, tags
+
+    @property
+    def text_array(self):
+        return [self.vocab[word_id] for word_id in self.token_ids]
+
+    # frequency weighted random lowercase word for a tag, None if the corpus has no such word
+    def random_word(self, tag):
+        tag_id = self.tag_index.get(tag)
+        if tag_id is None:
+            return None
+        start = end = 0
+        if tag_id + 1 < len(self.bucket_offsets):
+            start, end = self.bucket_offsets[tag_id], self.bucket_offsets[tag_id + 1]
+        compacted = self.bucket_weights[end - 1] if start < end else 0
+        total = compacted + self.pending_totals.get(tag_id, 0)
+        if total == 0:
+            return None
+        r = random.randrange(total)
+        if r < compacted:
+            n = bisect.bisect_right(self.bucket_weights, r, start, end)
+            return self.vocab[self.bucket_ids[n]]
+        r -= compacted
+        for word_id, count in self.pending_buckets[tag_id].items():
+            if r < count:
+                return self.vocab[word_id]
+            r -= count
+
+    def before_words(self, word):
+        return self.neighbours(word, self.before_offsets, self.before_ids, self.pending_before)
+
+    def after_words(self, word):
+        return self.neighbours(word, self.after_offsets, self.after_ids, self.pending_after)
+
+    def neighbours(self, word, offsets, ids, pending):
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            return []
+        words = []
+        if word_id + 1 < len(offsets):
+            words = [self.vocab[n] for n in ids[offsets[word_id]:offsets[word_id + 1]]]
+        return words + [self.vocab[n] for tag_id, n in pending.get(word_id, ())]
+
+    # first word seen before / after word in the corpus with the given tag in that position, None if there is none
+    def before_word(self, word, tag):
+        return self.tagged_neighbour(word, tag, self.before_offsets, self.before_ids, self.before_tags,
+                                     self.pending_before)
+
+    def after_word(self, word, tag):
+        return self.tagged_neighbour(word, tag, self.after_offsets, self.after_ids, self.after_tags,
+                                     self.pending_after)
+
+    def tagged_neighbour(self, word, tag, offsets, ids, tags, pending):
+        word_id = self.word_ids.get(word)
+        tag_id = self.tag_index.get(tag)
+        if word_id is None or tag_id is None:
+            return None
+        if word_id + 1 < len(offsets):
+            start, end = offsets[word_id], offsets[word_id + 1]
+            n = bisect.bisect_left(tags, tag_id, start, end)
+            if n < end and tags[n] == tag_id:
+                return self.vocab[ids[n]]
+        for neighbour_tag, n in pending.get(word_id, ()):
+            if neighbour_tag == tag_id:
+                return self.vocab[n]
+        return None
+
+    # add text to a built model in place, e.g. a recording while it is being transcribed; lookups see the new
+    # tokens right away, compact() folds them into the arrays
+    def extend(self, raw_text):
+        for word, tag in nltk.pos_tag(nltk.word_tokenize(raw_text)):
+            word_id = self.intern(word)
+            tag_id = self.tag_id(tag)
+            lower_id = self.lower_ids[word_id]
+            while len(self.word_counts) < len(self.vocab):
+                self.word_counts.append(0)
+                self.word_tags.append(255)
+            self.word_counts[word_id] += 1
+            for tagged_id in (word_id, lower_id):
+                if self.word_tags[tagged_id] == 255:
+                    self.word_tags[tagged_id] = tag_id
+            self.pending_buckets.setdefault(tag_id, collections.Counter())[lower_id] += 1
+            self.pending_totals[tag_id] = self.pending_totals.get(tag_id, 0) + 1
+            if len(self.token_ids) > 0:
+                previous_id, previous_tag = self.token_ids[-1], self.tag_ids[-1]
+                self.count_bigram(previous_id, word_id)
+                self.pending_after.setdefault(previous_id, []).append((tag_id, word_id))
+                self.pending_before.setdefault(word_id, []).append((previous_tag, previous_id))
+            self.token_ids.append(word_id)
+            self.tag_ids.append(tag_id)
+        self.collocations = {}  # found again on next use
+        self.big_word_offsets = None
+
+    # most frequent tag of a word in this corpus, replaces tagging single words with nltk.pos_tag
+    def word_tag(self, word):
+        word_id = self.word_ids.get(word)
+        if word_id is None or self.word_tags[word_id] == 255:
+            return None
+        return self.tags[self.word_tags[word_id]]
+
+    # big words by their corpus tag: ids of tag t are big_word_ids[big_word_offsets[t]:big_word_offsets[t + 1]]
+    def index_big_words(self):
+        big_words = sorted((self.word_tags[word_id], word_id) for word_id, count in enumerate(self.word_counts)
+                           if count > big_word_min_count and len(self.vocab[word_id]) >= big_word_length)
+        self.big_word_offsets = array('i', bytes(4 * (len(self.tags) + 1)))
+        self.big_word_ids = array('i', [word_id for tag_id, word_id in big_words])
+        for tag_id, word_id in big_words:
+            self.big_word_offsets[tag_id + 1] += 1
+        for tag_id in range(len(self.tags)):
+            self.big_word_offsets[tag_id + 1] += self.big_word_offsets[tag_id]
+
+    # random big word for a tag that has not been drawn for this poem yet, None once they are used up;
+    # drawn is the per poem state of a sparse Fisher-Yates shuffle, so nothing is copied per draw
+    def draw_big_word(self, tag, drawn):
+        if self.big_word_offsets is None:
+            self.index_big_words()  # text was added since the index was built
+        tag_id = self.tag_index.get(tag)
+        if tag_id is None:
+            return None
+        start, end = self.big_word_offsets[tag_id], self.big_word_offsets[tag_id + 1]
+        state = drawn.setdefault(tag_id, [0, {}])
+        used, swaps = state
+        if used >= end - start:
+            return None
+        n = used + random.randrange(end - start - used)
+        chosen = swaps.get(n, n)
+        swaps[n] = swaps.get(used, used)
+        state[0] = used + 1
+        return self.vocab[self.big_word_ids[start + chosen]]
+
+    def collocation_word(self, word_id):
+        global ignored_words
+        if ignored_words is None:
+            ignored_words = frozenset(nltk.corpus.stopwords.words('english'))
+        return len(self.vocab[word_id]) >= 3 and self.vocab[self.lower_ids[word_id]] not in ignored_words
+
+    def count_bigram(self, first_id, second_id):
+        if self.collocation_word(first_id) and self.collocation_word(second_id):
+            self.bigram_counts[(first_id, second_id)] += 1
+
+    # best collocations by a BigramAssocMeasures measure, each as [(word, tag), (word, tag)]
+    def find_collocations(self, measure='likelihood_ratio', n=collocation_count):
+        score = getattr(nltk_metrics.BigramAssocMeasures, measure)
+        total = len(self.token_ids)
+        scored = []
+        for (first_id, second_id), count in self.bigram_counts.items():
+            if count >= collocation_min_freq:
+                scored.append((-score(count, (self.word_counts[first_id], self.word_counts[second_id]), total),
+                               self.vocab[first_id], self.vocab[second_id], first_id, second_id))
+        collocations = []
+        for item in sorted(scored)[:n]:
+            collocations.append([(self.vocab[word_id], self.tags[self.word_tags[word_id]]) for word_id in item[3:]])
+        return collocations
+
+    def get_collocations(self, measure='likelihood_ratio'):
+        if measure not in self.collocations:
+            self.collocations[measure] = self.find_collocations(measure)
+        return self.collocations[measure]
+
+    # rough in-memory footprint, used by the corpus registry memory budget
+    def nbytes(self):
+        arrays = [value for value in vars(self).values() if isinstance(value, array)]
+        strings = sum(sys.getsizeof(word) for word in self.vocab)
+        bigrams = len(self.bigram_counts) * 150  # tuple key, int and dict slot per counted bigram
+        return sum(a.itemsize * len(a) for a in arrays) + strings + sys.getsizeof(self.word_ids) + bigrams
+
+    # cache key: source content + everything that changes the tagged output
+    def model_key(raw_bytes):
+        key = hashlib.sha1(raw_bytes)
+        nltk_version = ModelCache.package_version('nltk')
+        key.update('|{}|{}|{}'.format(model_version, nltk_version, tagger_version).encode('utf-8'))
+        return key.hexdigest()
+
+    # model_key of a source file without reading it into memory at once; cleaned sources get keys of their own
+    def file_key(source):
+        key = hashlib.sha1()
+        with open(source, 'rb') as file:
+            for block in iter(lambda: file.read(source_chunk_size), b''):
+                key.update(block)
+        if os.path.basename(source) in cleaned_sources:
+            key.update(b'|cleaned')
+        nltk_version = ModelCache.package_version('nltk')
+        key.update('|{}|{}|{}'.format(model_version, nltk_version, tagger_version).encode('utf-8'))
+        return key.hexdigest()
+
+    # model from pieces of text in order, e.g. the sentence chunks of a large source: windows of chunks are tagged
+    # on a process pool and appended in order, only token and tag ids are kept until the final compact(). With a
+    # checkpoint path, progress is saved there under key every build_checkpoint_seconds and a later build with
+    # the same key skips the chunks it already has; progress(characters) is called after every chunk
+    def build(chunks, processes=build_processes, checkpoint=None, key=None, progress=None):
+        text = Text('')
+        done, characters = 0, 0
+        state = ModelCache.load(checkpoint, key) if checkpoint is not None else None
+        if state is not None:
+            text.restore(state)
+            done, characters = state['chunks'], state['characters']
+        chunks = itertools.islice(chunks, done, None)
+        pool = None
+        if processes > 1:
+            pool = multiprocessing.get_context(pool_start_method).Pool(processes)
+        saved = time.perf_counter()
+        try:
+            while True:
+                window = list(itertools.islice(chunks, processes * 4))  # bounded, imap alone reads ahead
+                if not window:
+                    break
+                for length, tagged in (pool.imap(Text.tag_chunk, window) if pool else map(Text.tag_chunk, window)):
+                    text.add_tagged(tagged)
+                    done += 1
+                    characters += length
+                    metrics.count('corpus_build_chunks')
+                    if progress is not None:
+                        progress(characters)
+                if checkpoint is not None and time.perf_counter() - saved > build_checkpoint_seconds:
+                    ModelCache.save(checkpoint, key, text.checkpoint(done, characters))
+                    saved = time.perf_counter()
+        finally:
+            if pool is not None:
+                pool.terminate()
+        text.compact()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        return text
+
+    def tag_chunk(chunk):
+        return len(chunk), nltk.pos_tag(nltk.word_tokenize(chunk))
+
+    # what a chunked build needs to go on later, compact() rebuilds everything else
+    def checkpoint(self, chunks, characters):
+        return {'chunks': chunks, 'characters': characters, 'tags': self.tags, 'vocab': self.vocab,
+                'lower_ids': self.lower_ids, 'token_ids': self.token_ids, 'tag_ids': self.tag_ids}
+
+    def restore(self, state):
+        self.tags = state['tags']
+        self.tag_index = {tag: i for i, tag in enumerate(self.tags)}
+        self.vocab = state['vocab']
+        self.word_ids = {word: i for i, word in enumerate(self.vocab)}
+        self.lower_ids = state['lower_ids']
+        self.token_ids = state['token_ids']
+        self.tag_ids = state['tag_ids']
+
+    # a text file in pieces of about chunk_size characters, cut where cut_point(chunk) says; the rest of a piece is
+    # held back for the next one
+    def read_chunks(file, cut_point, chunk_size=source_chunk_size):
+        held = ''
+        while True:
+            data = file.read(chunk_size)
+            chunk = held + data
+            if not data:
+                if chunk:
+                    yield chunk
+                return
+            cut = cut_point(chunk)
+            if cut <= 0:
+                held = chunk  # no place to cut yet, read on
+                continue
+            held = chunk[cut:]
+            yield chunk[:cut]
+
+    # chunks ending after the last full sentence, or on whitespace when there is none
+    def sentence_chunks(file, chunk_size=source_chunk_size):
+        return Text.read_chunks(file, Text.sentence_cut, chunk_size)
+
+    def sentence_cut(chunk):
+        cut = max(chunk.rfind(end) for end in sentence_ends) + 1
+        if cut <= 0:
+            cut = max(chunk.rfind(' '), chunk.rfind('\n'))
+        return cut
+
+    # clean_pattern and clean_table over a text file chunk by chunk; chunks end on whitespace, so no word or
+    # multi character rule is cut in two
+    def clean_chunks(file, chunk_size=source_chunk_size):
+        for chunk in Text.read_chunks(file, Text.clean_cut, chunk_size):
+            yield Text.clean(chunk)
+
+    def clean_cut(chunk):
+        cut = max(chunk.rfind(' '), chunk.rfind('\n'))
+        tail = clean_tail.search(chunk, 0, max(cut, 0))
+        return cut if tail is None else tail.start()
+
+    def clean(raw_text):
+        return clean_pattern.sub('', raw_text).translate(clean_table)
+
+    def model_path(source):
+        return os.path.join(model_cache_dir, os.path.basename(source) + '.model')
+
+    # load the precompiled model for a source, re-tagging only when the source changed
+    def load(source):
+        if source in corpus_blends:
+            return BlendedText.load(source)
+        key = Text.file_key(source)
+        path = Text.model_path(source)
+        text = ModelCache.load(path, key)
+        if text is None:
+            with metrics.span('corpus_build', source=os.path.basename(source)):
+                text = Text.build_source(source, key)
+            ModelCache.save(path, key, text)
+        return text
+
+    # small sources are tagged in one go, large or cleaned ones chunk by chunk with progress and a checkpoint
+    def build_source(source, key):
+        name = os.path.basename(source)
+        size = os.path.getsize(source)
+        if name not in cleaned_sources and size < stream_build_size:
+            with open(source, 'rb') as file:
+                return Text(file.read().decode('utf-8'))
+        reported = [0]
+
+        def progress(characters):
+            percent = min(100, characters * 100 // max(size, 1))
+            if percent >= reported[0] + 10:
+                reported[0] = percent
+                print('Building {}: {}%'.format(name, percent))
+
+        with open(source, encoding='utf-8') as file:
+            # cleaned and tagged in one pass
+            chunks = Text.clean_chunks(file) if name in cleaned_sources else Text.sentence_chunks(file)
+            return Text.build(chunks, checkpoint=Text.model_path(source) + '.partial', key=key, progress=progress)
+
+
+# sorted vocabulary stored as one UTF-8 blob with offsets; word ids are positions in sorted order, so a word is
+# found with bisect instead of a dict
+class SortedVocab:
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, word_id):
+        return str(self.blob[self.offsets[word_id]:self.offsets[word_id + 1]], 'utf-8')
+
+    def get(self, word, default=None):
+        word_id = bisect.bisect_left(self, word)
+        if word_id < len(self) and self[word_id] == word:
+            return word_id
+        return default
+
+
+# read-only corpus model on a memory mapped file: every array is a view on the file, so processes opening the
+# same model share its pages through the page cache instead of each holding a copy; lookups are the ones of Text
+class MappedText(Text):
+
+    # after mapped_format: the header length, the JSON header with the key, tags, collocations and where each
+    # array starts counted from the first 8 byte boundary after the header; arrays are in native byte order
+    sections = ('vocab_offsets', 'vocab_blob', 'lower_ids', 'word_counts', 'word_tags', 'token_ids', 'tag_ids',
+                'before_offsets', 'before_ids', 'before_tags', 'after_offsets', 'after_ids', 'after_tags',
+                'bucket_offsets', 'bucket_ids', 'bucket_weights', 'big_word_offsets', 'big_word_ids')
+
+    def __init__(self, path, key):
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(mapped_format)] != mapped_format:
+            raise ValueError('not a mapped corpus model: ' + path)
+        length = int.from_bytes(self.map[len(mapped_format):len(mapped_format) + 4], 'little')
+        start = len(mapped_format) + 4
+        header = json.loads(str(self.map[start:start + length], 'utf-8'))
+        if header['key'] != key or header['byteorder'] != sys.byteorder:
+            raise ValueError('stale mapped corpus model: ' + path)
+        data = memoryview(self.map)[-(-(start + length) // 8) * 8:]
+        for name, (typecode, offset, count) in header['sections'].items():
+            setattr(self, name, data[offset:offset + count * array(typecode).itemsize].cast(typecode))
+        self.vocab = self.word_ids = SortedVocab(self.vocab_blob, self.vocab_offsets)
+        self.tags = header['tags']
+        self.tag_index = {tag: i for i, tag in enumerate(self.tags)}
+        self.collocations = {measure: [[tuple(pair[0]), tuple(pair[1])] for pair in collocations]
+                             for measure, collocations in header['collocations'].items()}
+        self.bigram_counts = collections.Counter()  # other measures than the stored ones find nothing
+        self.pending_before = {}
+        self.pending_after = {}
+        self.pending_buckets = {}
+        self.pending_totals = {}
+
+    def extend(self, raw_text):
+        raise TypeError('mapped corpus models are read-only')
+
+    def compact(self):
+        raise TypeError('mapped corpus models are read-only')
+
+    # the pages belong to the page cache, not to the process
+    def nbytes(self):
+        return 0
+
+    def path(source):
+        return os.path.join(model_cache_dir, os.path.basename(source) + '.map')
+
+    # mapped model of a source, written from its Text model when it is missing or stale
+    def load(source):
+        if source in corpus_blends:
+            return BlendedText.load(source, MappedText.load)
+        key = Text.file_key(source)
+        path = MappedText.path(source)
+        try:
+            text = MappedText(path, key)
+            metrics.count('model_cache', kind='map', result='hit')
+            return text
+        except (OSError, ValueError, KeyError):
+            metrics.count('model_cache', kind='map', result='miss')
+        MappedText.save(path, key, Text.load(source))
+        return MappedText(path, key)
+
+    # text with its word ids renumbered in sorted vocabulary order
+    def save(path, key, text):
+        if text.pending_totals or text.big_word_offsets is None:
+            text.compact()
+        order = sorted(range(len(text.vocab)), key=text.vocab.__getitem__)
+        new_ids = array('i', bytes(4 * len(order)))
+        for new_id, word_id in enumerate(order):
+            new_ids[word_id] = new_id
+
+        def renumber(ids):
+            return array('i', (new_ids[word_id] for word_id in ids))
+
+        def by_word(values):
+            return array(values.typecode, (values[word_id] for word_id in order))
+
+        # neighbour ranges moved to the new word order, each range keeps its tag sorted order
+        def by_word_ranges(offsets, ids, tags):
+            new_offsets, moved_ids, moved_tags = array('i', [0]), array('i'), array('B')
+            for word_id in order:
+                moved_ids.extend(new_ids[n] for n in ids[offsets[word_id]:offsets[word_id + 1]])
+                moved_tags.extend(tags[offsets[word_id]:offsets[word_id + 1]])
+                new_offsets.append(len(moved_ids))
+            return new_offsets, moved_ids, moved_tags
+
+        blob = bytearray()
+        vocab_offsets = array('i', [0])
+        for word_id in order:
+            blob += text.vocab[word_id].encode('utf-8')
+            vocab_offsets.append(len(blob))
+        arrays = {'vocab_offsets': vocab_offsets, 'vocab_blob': array('B', blob),
+                  'lower_ids': renumber(by_word(text.lower_ids)), 'word_counts': by_word(text.word_counts),
+                  'word_tags': by_word(text.word_tags), 'token_ids': renumber(text.token_ids),
+                  'tag_ids': text.tag_ids, 'bucket_offsets': text.bucket_offsets,
+                  'bucket_ids': renumber(text.bucket_ids), 'bucket_weights': text.bucket_weights,
+                  'big_word_offsets': text.big_word_offsets, 'big_word_ids': renumber(text.big_word_ids)}
+        for side in ('before', 'after'):
+            offsets, ids, tags = by_word_ranges(getattr(text, side + '_offsets'), getattr(text, side + '_ids'),
+                                                getattr(text, side + '_tags'))
+            arrays.update({side + '_offsets': offsets, side + '_ids': ids, side + '_tags': tags})
+
+        sections, offset = {}, 0
+        for name in MappedText.sections:
+            sections[name] = (arrays[name].typecode, offset, len(arrays[name]))
+            offset += -(-arrays[name].itemsize * len(arrays[name]) // 8) * 8
+        collocations = {measure: text.get_collocations(measure) for measure in collocation_measures}
+        header = json.dumps({'key': key, 'byteorder': sys.byteorder, 'tags': text.tags,
+                             'collocations': collocations, 'sections': sections}).encode('utf-8')
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(mapped_format + len(header).to_bytes(4, 'little') + header)
+            file.write(bytes(-file.tell() % 8))
+            for name in MappedText.sections:
+                arrays[name].tofile(file)
+                file.write(bytes(-file.tell() % 8))
+        os.replace(temp_path, path)  # workers never map a half written model
+
+
+# several corpus models mixed by weight at generation time, e.g. 70% Poe + 30% the latest recording, without
+# building a model of the combined text; every lookup asks the models in a weighted random order and takes the
+# first answer, so a model without an answer falls through to the next one
+class BlendedText:
+
+    def __init__(self, models):
+        self.models = [text for text, weight in models if weight > 0]
+        self.weights = [weight for text, weight in models if weight > 0]
+        self.by_weight = [text for text, weight in sorted(zip(self.models, self.weights), key=lambda m: -m[1])]
+        self.tags = []
+        for text in self.models:
+            self.tags += [tag for tag in text.tags if tag not in self.tags]
+
+    # the models of a corpus_blends entry, each loaded with load(source); sources not there yet, e.g. no
+    # recording so far, are left out of the mix
+    def load(name, load=Text.load):
+        models = []
+        for source, weight in corpus_blends[name]:
+            try:
+                models.append((load(source), weight))
+            except OSError:
+                pass
+        if not models:
+            raise FileNotFoundError('no source of blend ' + name)
+        return BlendedText(models)
+
+    # weighted random order without repeats: the first model is picked in proportion to its weight, and so on
+    def order(self):
+        keys = [(random.random() ** (1 / weight), i) for i, weight in enumerate(self.weights)]
+        return [self.models[i] for key, i in sorted(keys, reverse=True)]
+
+    def first(self, lookup, *args):
+        for text in self.order():
+            found = getattr(text, lookup)(*args)
+            if found is not None:
+                return found
+        return None
+
+    def random_word(self, tag):
+        return self.first('random_word', tag)
+
+    def before_word(self, word, tag):
+        return self.first('before_word', word, tag)
+
+    def after_word(self, word, tag):
+        return self.first('after_word', word, tag)
+
+    def before_words(self, word):
+        return [neighbour for text in self.order() for neighbour in text.before_words(word)]
+
+    def after_words(self, word):
+        return [neighbour for text in self.order() for neighbour in text.after_words(word)]
+
+    # the usual tag of a word stays the same from poem to poem: the heaviest model that knows the word decides
+    def word_tag(self, word):
+        for text in self.by_weight:
+            tag = text.word_tag(word)
+            if tag is not None:
+                return tag
+        return None
+
+    # drawn keeps a draw state per model, so big words are still not repeated within a poem
+    def draw_big_word(self, tag, drawn):
+        for text in self.order():
+            big_word = text.draw_big_word(tag, drawn.setdefault(id(text), {}))
+            if big_word is not None:
+                return big_word
+        return None
+
+    # collocations of every model, interleaved so that each place in the list comes from a model by weight
+    def get_collocations(self, measure='likelihood_ratio'):
+        lists = [list(text.get_collocations(measure)) for text in self.models]
+        collocations = []
+        while any(lists):
+            weights = [weight if left else 0 for weight, left in zip(self.weights, lists)]
+            collocations.append(random.choices(lists, weights)[0].pop(0))
+        return collocations
+
+
+# long lived, in memory corpus models shared by every command
+class CorpusRegistry:
+
+    def __init__(self, sources, memory_budget=corpus_memory_budget):
+        self.sources = sources
+        self.memory_budget = memory_budget
+        self.models = collections.OrderedDict()  # source -> (signature, text, nbytes), least recently used first
+        self.lock = threading.Lock()
+        self.source_locks = {source: threading.Lock() for source in sources}
+        self.preloader = threading.Thread(target=self.preload, daemon=True)
+        self.preloader.start()
+
+    def preload(self):
+        for source in self.sources:
+            try:
+                self.get(source)
+            except OSError:
+                pass  # source not there yet, e.g. nothing recorded
+
+    # a source is reloaded when its file changes, e.g. after a new recording
+    def signature(source):
+        stat = os.stat(source)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, source):
+        if source in corpus_blends:
+            return BlendedText.load(source, self.get)  # mixed from the models kept here, nothing is rebuilt
+        with self.lock:
+            source_lock = self.source_locks.setdefault(source, threading.Lock())
+        with source_lock:  # one build per source, concurrent builds for different sources
+            signature = CorpusRegistry.signature(source)
+            with self.lock:
+                entry = self.models.get(source)
+                if entry is not None and entry[0] == signature:
+                    self.models.move_to_end(source)
+                    metrics.count('corpus_registry', result='hit')
+                    return entry[1]
+            metrics.count('corpus_registry', result='miss')
+            text = Text.load(source)
+            with self.lock:
+                self.models[source] = (signature, text, text.nbytes())
+                self.models.move_to_end(source)
+                self.evict()
+            return text
+
+    # a model built elsewhere, e.g. the recording transcribed while it was recorded
+    def put(self, source, text):
+        with self.lock:
+            self.models[source] = (CorpusRegistry.signature(source), text, text.nbytes())
+            self.models.move_to_end(source)
+            self.evict()
+
+    def evict(self):
+        total = sum(entry[2] for entry in self.models.values())
+        while total > self.memory_budget and len(self.models) > 1:
+            source, entry = self.models.popitem(last=False)
+            total -= entry[2]
+            metrics.count('corpus_evictions')
+            print('Corpus evicted: ' + source + '\n')
+
+
+class Grammar:
+
+    def __init__(self, haiku, form=None):
+
+        # comment about what each part of speach is:
+        """ CC   - conjunction: or, but, and, either
+            CD   - number: one, two, three
+            DT   - determiner: a, an, the, both, all, these, any, some
+            EX   - the word 'there'
+            IN   - preposition: in, of, with, for, under, among, upon, at
+            JJ   - adjective: certain, curious, little, golden, other, offended
+            JJS  - adjective: -est : best, loveliest, largest
+            JJR  - adjective: -er : lerger, smaller, worse
+            MD   - can, dare, should, will*, might, could, must
+            NN   - common singular noun
+            NNS  - common plural noun
+            NNP  - proper singular noun
+            NNPS - proper plural noun
+            PDT  - all, both, quite, many, half
+            PRP  - hers, her, himself, thy, us, it, I, him, you, they
+            PRPP - possesive: his, mine, our, my, her, its, your
+            RB   - adverb: very, not, here, there, first, just, down, again, beautifully, -ly
+            RBR  - more
+            RBS  - adverb superlative: -est
+            RP   - participle: up, down, out, away, over, off
+            TO   - the word 'to'
+            UH   - interjection
+            VB   - vocative verb: to ___
+            VBD  - past verb: -ed : was*(freq. occur), had, dipped, were, said, seemed
+            VBG  - present verb: -ing: trembling, trying, getting, running, swimming
+            VBN  - past verb descriptive: crowded, mutated, fallen, lit, lost, forgtten
+            VBP  - present verb: not -s: am, wish, make, know, do, find
+            VBZ  - present verb: -s : is*, has, seems
+            WDT  - what, which, that*
+            WP   - who, what
+            WRB  - how, whenever, where, why, when
+        """
+
+        form = form or ('haiku' if haiku else 'free_form')
+        path = os.path.join(grammar_dir, form + '.cfg')
+        with open(path, 'rb') as file:
+            raw_bytes = file.read()
+        key = hashlib.sha1(raw_bytes + '|{}'.format(grammar_version).encode('utf-8')).hexdigest()
+        cache_path = os.path.join(model_cache_dir, form + '.grammar')
+        compiled = ModelCache.load(cache_path, key)
+        if compiled is None:
+            self.cfg = nltk.CFG.fromstring(raw_bytes.decode('utf-8'))  # only parsed when the grammar file changed
+            self.compile()
+            ModelCache.save(cache_path, key, (self.start, self.table, self.bounded))
+        else:
+            self.start, self.table, self.bounded = compiled
+
+    # compiled grammars are shared for the whole process, keyed by form and file state
+    def get(haiku, form=None):
+        form = form or ('haiku' if haiku else 'free_form')
+        stat = os.stat(os.path.join(grammar_dir, form + '.cfg'))
+        signature = (form, stat.st_mtime_ns, stat.st_size)
+        if signature not in compiled_grammars:
+            metrics.count('grammar_cache', result='miss')
+            compiled_grammars[signature] = Grammar(haiku, form)
+        else:
+            metrics.count('grammar_cache', result='hit')
+        return compiled_grammars[signature]
+
+    # poem forms available as grammar files, e.g. grammars/sonnet.cfg -> 'sonnet'
+    def forms():
+        return sorted(name[:-len('.cfg')] for name in os.listdir(grammar_dir) if name.endswith('.cfg'))
+
+    # lhs -> productions table with cumulative weights, terminals pre-split into tokens; productions that use a
+    # nonterminal without productions of its own are dropped, they can never expand
+    def compile(self):
+        productions = self.cfg.productions()
+        defined = set(prod.lhs().symbol() for prod in productions)
+        self.start = self.cfg.start().symbol()
+        rules = {}
+        for prod in productions:
+            rhs = []
+            for sym in prod.rhs():
+                if nltk.grammar.is_nonterminal(sym):
+                    rhs.append(sym.symbol())
+                else:
+                    rhs.append(tuple(sym.split()))
+            if all(isinstance(item, tuple) or item in defined for item in rhs):
+                rules.setdefault(prod.lhs().symbol(), []).append(tuple(rhs))
+
+        reaches = {}  # nonterminal -> every nonterminal its expansions can contain
+        for lhs in rules:
+            seen, todo = set(), [lhs]
+            while todo:
+                for rhs in rules.get(todo.pop(), []):
+                    for item in rhs:
+                        if not isinstance(item, tuple) and item not in seen:
+                            seen.add(item)
+                            todo.append(item)
+            reaches[lhs] = seen
+
+        self.table = {}    # lhs -> (productions, cumulative weights)
+        self.bounded = {}  # lhs -> (productions that never expand back into lhs, cumulative weights)
+        for lhs, prods in rules.items():
+            self.table[lhs] = (prods, list(range(1, len(prods) + 1)))
+            safe = [rhs for rhs in prods
+                    if all(isinstance(item, tuple) or (item != lhs and lhs not in reaches[item]) for item in rhs)]
+            self.bounded[lhs] = (safe, list(range(1, len(safe) + 1))) if safe else self.table[lhs]
+
+    # expand a nonterminal into a list of tag and word tokens
+    def gen_frame_line(self, nt=None, max_depth=frame_line_max_depth):
+        tokens = []
+        stack = [(nt or self.start, 0)]
+        while stack:
+            sym, depth = stack.pop()
+            if isinstance(sym, tuple):
+                tokens.extend(sym)
+                continue
+            prods, weights = (self.bounded if depth >= max_depth else self.table).get(sym, ((), ()))
+            if not prods:
+                continue  # ERROR: nothing to expand
+            rhs = random.choices(prods, cum_weights=weights)[0]
+            for item in reversed(rhs):
+                stack.append((item, depth + 1))
+        return tokens
+
+
+class Spot:
+    __slots__ = ('word', 'POS', 'line', 'column', 'filled', 'preset', 'frame')  # a poem has many, keep them small
+
+    def __init__(self, wop, line, column, content):
+        self.frame = None  # the frame indexing this spot, told when it is filled
+        if content == 'POS':
+            self.word = ''
+            self.POS = wop
+            self.line = line
+            self.column = column
+            self.filled = False
+            self.preset = False
+        elif content == 'word':
+            self.word = wop
+            self.POS = ''
+            self.line = line
+            self.column = column
+            self.filled = True
+            self.preset = True
+        else:
+            print(" ")  # spot content error
+
+    def fill(self, word):
+        self.word = word
+        self.filled = True
+        if self.frame is not None:
+            self.frame.spot_filled(self)
+
+    def add_POS(self, pos):
+        self.POS = pos
+
+
+class Frame:
+
+    def __init__(self, grammar, tags, length, haiku):
+        self.lines = []
+        tag_set = set(tags)
+        repeat_line_array = grammar.gen_frame_line()
+        if haiku == True:
+            x = 3
+            y = 2
+        elif haiku == False:
+            x = random.randint(0, length)
+            y = random.randint(0, length)
+        for i in range(length):
+            if (i == x or i == y):
+                spot_array = []
+                j = 0
+                noun_set = set(['he', 'she', 'it', 'I'])
+                for wop in repeat_line_array:
+                    if wop in tag_set:
+                        spot = Spot(wop, i, j, 'POS')
+                        if (wop in noun_set):
+                            spot.add_POS('NN')
+                        spot_array.append(spot)
+                    else:
+                        spot = Spot(wop, i, j, 'word')
+                        spot_array.append(spot)
+                    j += 1
+                self.lines.append(spot_array)
+            else:
+                line_array = grammar.gen_frame_line()
+                spot_array = []
+                j = 0
+                for wop in line_array:
+                    if wop in tag_set:
+                        spot = Spot(wop, i, j, 'POS')
+                        spot_array.append(spot)
+                    else:
+                        spot = Spot(wop, i, j, 'word')
+                        spot_array.append(spot)
+                    j += 1
+                self.lines.append(spot_array)
+        self.index()
+
+    # unfilled spots by POS, by the POS pair of two adjacent unfilled spots and as a flat list for random picks;
+    # kept up to date by spot_filled as spots are filled
+    def index(self):
+        self.open_by_POS = {}      # POS -> {spot: None}, in frame order
+        self.open_pairs = {}       # (POS, POS) -> {first spot of the pair: None}, in frame order
+        self.open_spots = []       # unfilled spots in no order
+        self.open_positions = {}   # spot -> its place in open_spots
+        for line in self.lines:
+            for spot in line:
+                spot.frame = self
+                if not spot.filled:
+                    self.open_by_POS.setdefault(spot.POS, {})[spot] = None
+                    self.open_positions[spot] = len(self.open_spots)
+                    self.open_spots.append(spot)
+            for first, second in zip(line, line[1:]):
+                if not first.filled and not second.filled:
+                    self.open_pairs.setdefault((first.POS, second.POS), {})[first] = None
+
+    def spot_filled(self, spot):
+        self.open_by_POS.get(spot.POS, {}).pop(spot, None)
+        n = self.open_positions.pop(spot, None)
+        if n is not None:
+            last = self.open_spots.pop()  # the last spot takes the place of the filled one
+            if last is not spot:
+                self.open_spots[n] = last
+                self.open_positions[last] = n
+        line = self.lines[spot.line]
+        if spot.column > 0:
+            before = line[spot.column - 1]
+            self.open_pairs.get((before.POS, spot.POS), {}).pop(before, None)
+        if spot.column < len(line) - 1:
+            self.open_pairs.get((spot.POS, line[spot.column + 1].POS), {}).pop(spot, None)
+
+    # every collocation that still has two adjacent open spots with its tags, best ranked first
+    def add_collocations(self, text):
+        for (first_word, first_tag), (second_word, second_tag) in text.get_collocations():
+            pairs = self.open_pairs.get((first_tag, second_tag))
+            if pairs:
+                first = next(iter(pairs))
+                second = self.lines[first.line][first.column + 1]
+                first.fill(first_word)
+                second.fill(second_word)
+
+    # open spots tag by tag, a tag is left as soon as its big words run out
+    def add_big_words(self, text):
+        drawn = {}  # big words are not repeated within a poem
+        for pos, spots in list(self.open_by_POS.items()):
+            for spot in list(spots):
+                big_word = text.draw_big_word(pos, drawn)
+                if big_word is None:
+                    break
+                spot.fill(big_word)
+
+    def repeat_nouns(self, length):
+        noun = ''
+        for spot in self.lines[0]:
+            if spot.POS == 'NN' and spot.filled == True:
+                noun = spot.word
+                break
+        if noun == '': return
+        for i in range(1, length):
+            for spot in self.lines[i]:
+                if spot.POS == 'NN' and spot.filled == False:
+                    spot.fill(noun)
+                    break
+
+    # context='corpus' takes the neighbour tags from the tagged corpus through the (word, tag) index,
+    # context='lexicon' scans all neighbours and compares the usual tag of each neighbour word
+    def add_context_words(self, text, context='corpus', lines=None):
+        for line in lines or self.lines:
+            for spot in line:
+                if spot.filled == True:
+                    if spot.column > 0 and line[spot.column - 1].filled == False and spot.preset == False:
+                        before_word = self.context_word(text.before_word, text.before_words, text, spot.word,
+                                                        line[spot.column - 1].POS, context)
+                        if before_word is not None:
+                            line[spot.column - 1].fill(before_word)
+                    if spot.column < len(line) - 1 and line[spot.column + 1].filled == False and spot.preset == False:
+                        after_word = self.context_word(text.after_word, text.after_words, text, spot.word,
+                                                       line[spot.column + 1].POS, context)
+                        if after_word is not None:
+                            line[spot.column + 1].fill(after_word)
+
+    def context_word(self, tagged_neighbour, neighbours, text, word, pos, context):
+        if context == 'corpus':
+            return tagged_neighbour(word, pos)
+        for neighbour in neighbours(word):
+            if text.word_tag(neighbour) == pos:
+                return neighbour
+        return None
+
+    # one open spot picked at random
+    def add_random(self, text):
+        if not self.open_spots:
+            return
+        spot = random.choice(self.open_spots)
+        word = text.random_word(spot.POS)
+        if word is not None:
+            spot.fill(word)
+
+    def add_first_unfilled(self, text, lines=None):
+        for line in lines or self.lines:
+            for spot in line:
+                if spot.filled == False:
+                    word = text.random_word(spot.POS)
+                    if word is not None:
+                        spot.fill(word)
+                    break
+
+    def fill_remaining(self, text, lines=None):
+        for line in lines or self.lines:
+            for spot in line:
+                if not spot.filled:
+                    word = text.random_word(spot.POS)
+                    if word is not None:
+                        spot.fill(word)
+
+    # finish the poem one line at a time and yield each line as soon as it is filled; the collocation,
+    # big word and noun passes over the whole frame have to run first
+    def fill_lines(self, text, length):
+        for i, line in enumerate(self.lines):
+            with metrics.span('generate', stage='line'):
+                for x in range(3):
+                    self.add_context_words(text, lines=[line])
+                self.add_first_unfilled(text, [line])
+                if i == 0:
+                    self.repeat_nouns(length)  # the first line is final now, carry its noun through the poem
+                self.add_context_words(text, lines=[line])
+                self.fill_remaining(text, [line])
+            yield Frame.text_line(line)
+
+    def text_line(line):
+        return ' '.join(spot.word if spot.filled else spot.POS for spot in line)
+
+    def text_lines(self):
+        return [Frame.text_line(line) for line in self.lines]
+
+    def print(self):
+        for line in self.text_lines():
+            print(line)
+        print()
+
+
+# a finished poem and what it was generated from
+class Poem:
+
+    def __init__(self, lines, source, length, haiku, form=None):
+        self.lines = lines
+        self.source = source
+        self.length = length
+        self.haiku = haiku
+        self.form = form or ('haiku' if haiku else 'free_form')
+        self.created = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    def text(self):
+        return ''.join(line + ' \n' for line in self.lines) + '\n'
+
+
+# bounded queues of pre-generated poems per (source, length, haiku), refilled by a background thread while
+# nothing else needs the CPU; the box pauses it while recording or speaking
+class PoemPool:
+
+    def __init__(self, registry, sources, types=poem_types, size=poem_pool_size):
+        self.registry = registry
+        self.size = size
+        self.queues = collections.OrderedDict()
+        for source in sources:
+            for length, haiku in types.values():
+                self.queues[(source, length, haiku)] = collections.deque()
+        self.missing = set()           # sources that could not be loaded, retried when asked for
+        self.lock = threading.Lock()
+        self.wanted = threading.Event()
+        self.wanted.set()
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.pauses = 0
+        self.worker = threading.Thread(target=self.refill, daemon=True)
+        self.worker.start()
+
+    # ready poem or None; poems made from an older version of the source are dropped
+    def take(self, source, length, haiku):
+        key = (source, length, haiku)
+        poem = None
+        with self.lock:
+            queue = self.queues.get(key)
+            self.missing.discard(source)
+            try:
+                signature = CorpusRegistry.signature(source)
+            except OSError:
+                signature = None
+            while queue and poem is None:
+                queued_signature, queued_poem = queue.popleft()
+                if queued_signature == signature:
+                    poem = queued_poem
+            self.wanted.set()
+        metrics.count('poem_pool', result='hit' if poem is not None else 'miss')
+        return poem
+
+    def pause(self):
+        with self.lock:
+            self.pauses += 1
+            self.resumed.clear()
+
+    def resume(self):
+        with self.lock:
+            self.pauses = max(0, self.pauses - 1)
+            if self.pauses == 0:
+                self.resumed.set()
+
+    # the refill thread outlives any error, it only waits a while before trying again
+    def failed(self, e):
+        print('Poem pool refill failed: {}\n'.format(e))
+        metrics.count('poem_pool_failures', error=type(e).__name__)
+        time.sleep(poem_pool_retry_seconds)
+
+    # emptiest queue that is not full, None when everything is topped up
+    def next_key(self):
+        keys = [key for key, queue in self.queues.items() if len(queue) < self.size and key[0] not in self.missing]
+        if not keys:
+            return None
+        return min(keys, key=lambda key: len(self.queues[key]))
+
+    def refill(self):
+        while True:
+            self.wanted.wait()
+            self.resumed.wait()
+            with self.lock:
+                key = self.next_key()
+                if key is None:
+                    self.wanted.clear()
+                    continue
+            source, length, haiku = key
+            try:
+                signature = CorpusRegistry.signature(source)
+                text = self.registry.get(source)
+            except OSError:
+                with self.lock:
+                    self.missing.add(source)
+                continue
+            except Exception as e:
+                self.failed(e)
+                continue
+            try:
+                poem = Generator.generate_poem(text, source, length, haiku)
+            except Exception as e:
+                self.failed(e)
+                continue
+            with self.lock:
+                self.queues[key].append((signature, poem))
+
+
+# poem generation on top of the corpus models, without any hardware or speech
+class Generator:
+
+    def generate_poem(text, source, length, haiku, form=None):
+        lines = list(Generator.generate_lines(text, length, haiku, form))
+        return Poem(lines, source, length, haiku, form)
+
+    def generate_lines(text, length, haiku, form=None):
+        with metrics.span('generate', stage='grammar'):
+            grammar = Grammar.get(haiku, form)  # compiled CFG, shared by every poem
+        with metrics.span('generate', stage='frame'):
+            frame = Frame(grammar, text.tags, length, haiku)  # create "frame" of poem: list of lists of POS tags
+        with metrics.span('generate', stage='collocations'):
+            frame.add_collocations(text)
+        with metrics.span('generate', stage='big_words'):
+            frame.add_big_words(text)
+        frame.repeat_nouns(length)
+        return frame.fill_lines(text, length)
+
+    # n poems for every (source, poem type) combination, e.g. generate_batch(['poe_all.txt'], ['haiku'], 5);
+    # processes > 1 fans the poems out over a process pool whose workers share memory mapped corpus models
+    def generate_batch(sources, types, n, processes=1, registry=None):
+        jobs = [(source, poem_types[type]) for source in sources for type in types for i in range(n)]
+        if processes <= 1:
+            for source in sources:
+                batch_models[source] = registry.get(source) if registry is not None else Text.load(source)
+            return [Generator.batch_job(job) for job in jobs]
+        for source in sources:
+            MappedText.load(source)  # written once here if missing, then only mapped by the workers
+        context = multiprocessing.get_context(pool_start_method)
+        with context.Pool(processes, initializer=Generator.init_batch_worker,
+                          initargs=(sources, model_cache_dir)) as pool:
+            return pool.map(Generator.batch_job, jobs, chunksize=max(1, len(jobs) // (processes * 4)))
+
+    # every worker maps the models written by generate_batch, the pages are shared between all of them instead of
+    # each worker holding a copy of its own
+    def init_batch_worker(sources, cache_dir):
+        global model_cache_dir
+        model_cache_dir = cache_dir  # workers start from a fresh import of this module
+        random.seed()
+        for source in sources:
+            batch_models[source] = MappedText.load(source)
+
+    def batch_job(job):
+        source, (length, haiku) = job
+        return Generator.generate_poem(batch_models[source], source, length, haiku)
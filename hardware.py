@@ -0,0 +1,151 @@
+# Board interface of the poetry box: the Arduino behind the servos, LEDs and stop button, an in-memory simulator
+# with the same methods, and the servo / LED choreography that runs next to generation instead of before it.
+import contextvars
+import importlib
+import queue
+import threading
+import time
+from instrumentation import metrics
+
+
+# the Arduino Uno running the Python-Arduino prototyping sketch
+class ArduinoBoard:
+
+    def __init__(self, baud, port):
+        Arduino = importlib.import_module('Arduino')
+        self.board = Arduino.Arduino(baud, port=port)
+        self.lock = threading.Lock()  # one serial command at a time, choreography runs on its own thread
+
+    def pin_mode(self, pin, mode):
+        with self.lock:
+            self.board.pinMode(pin, mode)
+
+    def attach_servo(self, pin):
+        with self.lock:
+            self.board.Servos.attach(pin)
+
+    def write_servo(self, pin, angle):
+        with self.lock:
+            self.board.Servos.write(pin, angle)
+
+    def digital_write(self, pin, value):
+        with self.lock:
+            self.board.digitalWrite(pin, value)
+
+    def analog_read(self, pin):
+        with self.lock:
+            return self.board.analogRead(pin)
+
+
+# in-memory board for running and benchmarking the box on any machine; every write is logged with its time
+class SimulatedBoard:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.modes = {}
+        self.servos = {}
+        self.pins = {}
+        self.analog = {}     # pin -> value analog_read returns, see press()
+        self.log = []        # (time, method, pin, value)
+
+    def record(self, method, pin, value):
+        with self.lock:
+            self.log.append((time.perf_counter(), method, pin, value))
+
+    def pin_mode(self, pin, mode):
+        self.modes[pin] = mode
+        self.record('pin_mode', pin, mode)
+
+    def attach_servo(self, pin):
+        self.servos[pin] = 90
+        self.record('attach_servo', pin, None)
+
+    def write_servo(self, pin, angle):
+        self.servos[pin] = angle
+        self.record('write_servo', pin, angle)
+
+    def digital_write(self, pin, value):
+        self.pins[pin] = value
+        self.record('digital_write', pin, value)
+
+    def analog_read(self, pin):
+        return self.analog.get(pin, 0)
+
+    # simulate the stop button, 1000 pressed and 0 released like the real analog pin
+    def press(self, pin, value=1000):
+        self.analog[pin] = value
+
+
+# speech engine stand-in for the simulator: keeps what would have been said instead of speaking it
+class SimulatedEngine:
+
+    def __init__(self, seconds_per_word=0.0):
+        self.seconds_per_word = seconds_per_word
+        self.properties = {'rate': 160, 'voice': None, 'voices': [None, None]}
+        self.queued = []
+        self.spoken = []
+
+    def getProperty(self, name):
+        return self.properties.get(name)
+
+    def setProperty(self, name, value):
+        self.properties[name] = value
+
+    def say(self, text):
+        self.queued.append(text)
+
+    def runAndWait(self):
+        for text in self.queued:
+            time.sleep(self.seconds_per_word * len(text.split()))
+            self.spoken.append(text)
+        self.queued = []
+
+    def stop(self):
+        self.queued = []
+
+
+# plays servo / LED sequences on a background thread, in the order they were queued; a sequence is a list of
+# ('servo', pin, angle), ('led', pin, 'HIGH' / 'LOW') and ('wait', seconds) steps
+class Choreographer:
+
+    def __init__(self, board):
+        self.board = board
+        self.sequences = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def play(self, steps):
+        self.sequences.put((contextvars.copy_context(), steps))  # animate spans join the trace that queued them
+
+    # drops the sequences that have not started yet, e.g. those of an interrupted command
+    def clear(self):
+        while True:
+            try:
+                self.sequences.get_nowait()
+            except queue.Empty:
+                return
+            self.sequences.task_done()
+
+    # blocks until everything queued so far has been played, e.g. before recording
+    def wait(self):
+        self.sequences.join()
+
+    def run(self):
+        while True:
+            context, steps = self.sequences.get()
+            try:
+                context.run(self.play_steps, steps)
+            except Exception as e:
+                print('Choreography failed: {}\n'.format(e))
+            finally:
+                self.sequences.task_done()
+
+    def play_steps(self, steps):
+        with metrics.span('animate'):
+            for step in steps:
+                if step[0] == 'servo':
+                    self.board.write_servo(step[1], step[2])
+                elif step[0] == 'led':
+                    self.board.digital_write(step[1], step[2])
+                elif step[0] == 'wait':
+                    time.sleep(step[1])
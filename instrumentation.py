@@ -0,0 +1,145 @@
+# Spans, counters and latency histograms for the box. Every command is a trace of nested spans (wake, recognize,
+# animate, generate stages, speech); finished spans feed one latency histogram per span name. Spans and counts can
+# be appended to a JSONL log and counters and histograms are served as Prometheus text on /metrics.
+import bisect
+import contextlib
+import contextvars
+import http.server
+import itertools
+import json
+import threading
+import time
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # seconds
+metrics_prefix = 'poetry_box'
+current_span = contextvars.ContextVar('current_span', default=None)  # (trace id, span id) of the open span
+span_ids = itertools.count(1)
+
+
+class Metrics:
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}     # (name, labels) -> count
+        self.histograms = {}   # (name, labels) -> [count per bucket..., count above the last bucket, sum]
+        self.log = None        # JSONL file, see log_to()
+        self.server = None     # Prometheus endpoint, see serve()
+
+    def labels(labels):
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def count(self, name, value=1, **labels):
+        key = (name, Metrics.labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.write({'type': 'count', 'name': name, 'value': value, 'labels': labels, 'time': time.time()})
+
+    def observe(self, name, seconds, **labels):
+        key = (name, Metrics.labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[-1] += seconds
+
+    # starts a new trace in this context before any span is open, e.g. to listen for a command and handle it as
+    # one trace; the spans opened in this context from now on are its roots
+    def trace(self):
+        current_span.set((next(span_ids), None))
+
+    # times the block as a child of the span open in this context; spans cross threads with contextvars,
+    # e.g. executor.submit(contextvars.copy_context().run, function)
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        parent = current_span.get()
+        span_id = next(span_ids)
+        trace_id = parent[0] if parent is not None else span_id
+        token = current_span.set((trace_id, span_id))
+        started = time.time()
+        clock = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__  # cancelled commands show up as CancelledError
+            raise
+        finally:
+            seconds = time.perf_counter() - clock
+            current_span.reset(token)
+            self.observe(name, seconds, **labels)
+            self.write({'type': 'span', 'name': name, 'trace': trace_id, 'span': span_id,
+                        'parent': parent[1] if parent is not None else None, 'start': started,
+                        'seconds': seconds, 'labels': labels, 'error': error})
+
+    # append every finished span and count to a JSONL file from now on
+    def log_to(self, path):
+        self.log = open(path, 'a', buffering=1)
+
+    def write(self, event):
+        if self.log is not None:
+            line = json.dumps(event) + '\n'
+            with self.lock:
+                self.log.write(line)
+
+    def prometheus(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(histogram)) for key, histogram in self.histograms.items())
+        lines = []
+        previous = None
+        for (name, labels), value in counters:
+            metric = '{}_{}_total'.format(metrics_prefix, name)
+            if metric != previous:
+                lines.append('# TYPE {} counter'.format(metric))
+                previous = metric
+            lines.append('{}{} {}'.format(metric, Metrics.format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            metric = '{}_{}_seconds'.format(metrics_prefix, name)
+            if metric != previous:
+                lines.append('# TYPE {} histogram'.format(metric))
+                previous = metric
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), histogram[:-1]):
+                total += count
+                bucket_labels = Metrics.format_labels(labels + (('le', str(bound)),))
+                lines.append('{}_bucket{} {}'.format(metric, bucket_labels, total))
+            lines.append('{}_sum{} {}'.format(metric, Metrics.format_labels(labels), histogram[-1]))
+            lines.append('{}_count{} {}'.format(metric, Metrics.format_labels(labels), total))
+        return '\n'.join(lines) + '\n'
+
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, Metrics.escape(value)) for name, value in labels) + '}'
+
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    # Prometheus text format on http://host:port/metrics, served from a background thread
+    def serve(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # scrapes are not worth a line on the console
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+
+metrics = Metrics()
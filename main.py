@@ -1,32 +1,44 @@
-# Text to speech toolkits
-import speech_recognition as sr
-import pyttsx3
-from pydub import AudioSegment
-from pydub.utils import make_chunks
+import time
+boot_started = time.perf_counter()  # cold start is measured from here
+# Text to speech toolkits, imported on first use
 import wave
-import pyaudio
-# Generator Natural Langugae Tool Kit
-import nltk
-from nltk.data import load
-from nltk import CFG
-from nltk.grammar import is_nonterminal
-from nltk.collocations import BigramCollocationFinder
-from nltk.metrics import BigramAssocMeasures
-from nltk.corpus import stopwords
+import array
 # Other Toolkits
 import random
-import sys  # print logging save to file - pip install os-sys
-import re
-from Arduino import Arduino
-import time
+import os
+import threading
+import collections
+import queue
+import sqlite3
+import io
+import urllib.request
+import concurrent.futures
+import asyncio
+import contextvars
+from generator import Lazy, ModelCache, Text, CorpusRegistry, Grammar, Poem, PoemPool, Generator, corpus_sources, \
+    corpus_blends
+from hardware import ArduinoBoard, SimulatedBoard, SimulatedEngine, Choreographer
+from instrumentation import metrics
+
+sr = Lazy.module('speech_recognition')
+pyttsx3 = Lazy.module('pyttsx3')
+pyaudio = Lazy.module('pyaudio')
 
 # Global TTS variables
-listener = sr.Recognizer()
-engine = pyttsx3.init()
-voices = engine.getProperty('voices')
-engine.setProperty('voice', voices[1].id)
 poetry_voice_rate = 120
 normal_voice_rate = 160
+record_rate = 16000                         # recordings are stored as mono 16 kHz, all speech recognition needs
+transcribe_chunk_ms = 10000                 # recordings are transcribed in chunks of this length
+transcribe_workers = 4                      # chunks transcribed at the same time
+recognizer_name = 'google'                  # speech_recognition recognize_<name>, e.g. 'sphinx' offline, or 'local'
+local_recognizer_url = 'http://127.0.0.1:8765/recognize'  # 'local': POST a WAV, get plain text back
+cold_start_budget = 1.0                     # seconds from start to listening
+button_poll_interval = 0.05                 # seconds between stop button reads in the async runtime
+speech_interrupted = threading.Event()      # set to cut speech short, e.g. by a new command or the stop button
+metrics_log = os.environ.get('POETRY_BOX_METRICS_LOG')              # JSONL file for spans and counts, unset is off
+metrics_port = int(os.environ.get('POETRY_BOX_METRICS_PORT', '0'))  # Prometheus text on /metrics, 0 is off
+command_kinds = ('listen', 'read', 'save', 'retrieve', 'generate')
+wake_word = 'edgar'                         # needed to interrupt a running command, the box hears itself speak
 
 # Arduino Initialise
 red_led_pin = 5                             # recording
@@ -36,366 +48,94 @@ type_servo_pin = 4                          # poetry types          - 20 haiku,
 button_pin = 2                              # stop recording
 baud = '115200'
 port = '/dev/ttyACM0'                      #  '/dev/ttyACM0' - on RPI or 'COM3' - on windows
-board = Arduino(baud, port=port)
-
-board.pinMode(red_led_pin, "OUTPUT")        # REC
-board.pinMode(white_led_pin, "OUTPUT")      # Store
-board.Servos.attach(choice_servo_pin)       # servo 1
-board.Servos.attach(type_servo_pin)         # servo 2
-stop_button = board.analogRead(button_pin)  # stop button analog 0 or 1000
-
-
-# ----------------------------------------------- Generator Setup ----------------------------------------------
-class Text:
-    def __init__(self, raw_text):
-        self.text_array = nltk.word_tokenize(raw_text)
-        self.POS_buckets = {}
-        tagged_text_array = nltk.pos_tag(self.text_array)
-        self.tags = load('help/tagsets/upenn_tagset.pickle')
-        for tag in self.tags:
-            self.POS_buckets[tag] = []
-        for tuple in tagged_text_array:
-            self.POS_buckets[tuple[1]].append(tuple[0].lower())
-        self.before = {}
-        self.after = {}
-        for word in self.text_array:
-            self.before[word] = []
-            self.after[word] = []
-        for i in range(len(self.text_array)):  # range goes to one less than given value
-            if i > 0:
-                self.before[self.text_array[i]].append(self.text_array[i - 1])
-            if i < len(self.text_array) - 1:
-                self.after[self.text_array[i]].append(self.text_array[i + 1])
-
-    # return list of two word collocation lists
-    def get_collocations(self):
-        ignored_words = stopwords.words('english')
-        finder = BigramCollocationFinder.from_words(self.text_array, 2)
-        finder.apply_freq_filter(3)
-        finder.apply_word_filter(lambda w: len(w) < 3 or w.lower() in ignored_words)
-        bigram_measures = BigramAssocMeasures()
-        return finder.nbest(bigram_measures.likelihood_ratio, 40)
-
-
-class Grammar:
-
-    def __init__(self, haiku):
-
-        # comment about what each part of speach is:
-        """ CC   - conjunction: or, but, and, either
-            CD   - number: one, two, three
-            DT   - determiner: a, an, the, both, all, these, any, some
-            EX   - the word 'there'
-            IN   - preposition: in, of, with, for, under, among, upon, at
-            JJ   - adjective: certain, curious, little, golden, other, offended
-            JJS  - adjective: -est : best, loveliest, largest
-            JJR  - adjective: -er : lerger, smaller, worse
-            MD   - can, dare, should, will*, might, could, must
-            NN   - common singular noun
-            NNS  - common plural noun
-            NNP  - proper singular noun
-            NNPS - proper plural noun
-            PDT  - all, both, quite, many, half
-            PRP  - hers, her, himself, thy, us, it, I, him, you, they
-            PRPP - possesive: his, mine, our, my, her, its, your
-            RB   - adverb: very, not, here, there, first, just, down, again, beautifully, -ly
-            RBR  - more
-            RBS  - adverb superlative: -est
-            RP   - participle: up, down, out, away, over, off
-            TO   - the word 'to'
-            UH   - interjection
-            VB   - vocative verb: to ___
-            VBD  - past verb: -ed : was*(freq. occur), had, dipped, were, said, seemed
-            VBG  - present verb: -ing: trembling, trying, getting, running, swimming
-            VBN  - past verb descriptive: crowded, mutated, fallen, lit, lost, forgtten
-            VBP  - present verb: not -s: am, wish, make, know, do, find
-            VBZ  - present verb: -s : is*, has, seems
-            WDT  - what, which, that*
-            WP   - who, what
-            WRB  - how, whenever, where, why, when
-        """
-
-        # create base of cfg
-        if not haiku:
-            g = CFG.fromstring("""
-            S -> NPS VPS | NPS VPS | NPS VPS | NPP VPP | VPO | NPO
-            S -> NPS VPS | NPP VPP | NPS VPS
-
-            NPS -> 'DT' 'NN' | 'DT' 'NN' | 'DT' 'JJ' 'NN' | 'DT' 'JJ' 'NN'
-            NPS -> 'EX' 'the' 'NN' | 'the' 'JJS' 'NN'
-            NPS -> 'she' | 'he' | 'it' | 'I'
-            NPS -> NPS INP | INP NPS
-
-            NPP -> 'the' 'NNS' | 'the' 'NNS' | 'NNS'
-            NPP -> 'the' 'JJ' 'NNS'
-            NPP -> 'they' | 'you' | 'we'
-
-            VING -> 'VBG' | 'VBG' | 'RB' 'VBG'
-            VBB -> 'VB' | 'VB' | 'VBP'
-
-            SM -> 'is' | 'was' | 'has been'
-
-            VPS -> SM 'VBN' | SM 'VBN' 'like the' 'JJ' 'NN'
-            VPS -> SM VING | SM VING INP
-            VPS -> SM VING 'like' 'DT' 'JJ' 'NN'
-            VPS -> SM VING 'like a' 'NN' INP
-            VPS -> SM 'as' 'JJ' 'as' 'JJ'
-            VPS -> SM 'a' 'JJ' 'NN'
-            VPS -> SM 'a' 'NN' INP
-            VPS -> 'MD' 'have been' VING
-            VPS -> 'is' 'JJ' 'and' 'JJ'
-            VPS -> 'VBD' INP | 'RB' 'VBD'
-            VPS -> SM 'VBD' 'like' 'DT' 'JJ' 'NN'
-            VPS -> SM 'as' 'JJ' 'as the' 'NN'
-            VPS -> 'VBD' 'NN' | 'VBD' 'DT' 'NN'
-            VPS -> 'VBD' 'and' 'VBD' INP 'until' 'VBN'
-            VPS -> VPS 'and' S
-            VPS -> 'VBD' 'JJR' 'than' 'a' 'NN'
-            VPS -> 'VBD' 'EX'
-            VPS -> SM 'JJ' | SM 'VB' INP
-
-            NPO -> 'a' 'NN' 'IN' 'NNP'
-            NPO -> 'the' 'NN' 'IN' 'the' 'JJ' 'NNP'
-            NPO -> 'the' 'NNS' 'IN' 'the' 'NN'
-
-            VPO -> 'VBG' 'like' 'NNP' 'RP' 'DT' 'JJ' 'NN' 'IN' 'DT' 'NN'
-            VPO -> 'has been' 'VBG' 'RP' 'and' 'VBG'
-
-            PM -> 'are' | 'were' | 'have been'
-
-            VPP -> PM VING | PM VING INP
-            VPP -> PM VING 'like the' 'NNS' INP
-            VPP -> PM 'as' 'JJ' 'as' NPS INP | PM 'JJ' 'like' 'NNS' | PM 'JJ' 'like' VBG 'NNS'
-            VPP -> PM 'VBN' | PM 'VBN' INP
-            VPP -> PM 'as' 'JJ' 'as' 'JJ' | PM 'as' 'JJ' 'as' 'VBG' 'NNS'
-            VPP -> PM 'NNS' INP
-            VPP -> PM 'JJ' 'NNS'
-            VPP -> 'are' 'JJ' 'and' 'JJ'
-            VPP -> 'VBD' INP | 'VBD' 'RP' INP
-            VPP -> PM 'JJ' | PM 'VB' INP
-
-            INP -> 'IN' 'DT' 'NN' | 'IN' 'the' 'NNS' | 'IN' 'the' 'JJ' 'NNS'
-            INP -> 'IN' 'DT' 'NN' 'IN' 'DT' 'NN'
-            INP -> 'IN' 'DT' 'JJ' 'NN' | 'RP' 'IN' 'DT' 'JJ' 'NN'
-            INP -> 'RP' 'IN' 'DT' 'NN' | 'IN' 'JJ' 'NNS'
-            INP -> 'IN' 'DT' 'NN' | 'RP' 'DT' 'NNS'
-            """)
-
-            # save grammar to self.cfg
-            self.cfg = CFG.fromstring(str(g).split('\n')[1:])
-            self.cfg._start = g.start()
-
-        elif haiku:
-            g2 = CFG.fromstring("""
-                        S ->  'DT' 'JJ' 'NNS'
-                        S -> 'VBD' 'NNS'
-                        S ->  'NNS' 'VBD'
-
-                        """)
-
-            self.cfg = CFG.fromstring(str(g2).split('\n')[1:])
-            self.cfg._start = g2.start()
-
-    def gen_frame_line(self, nt):
-        sentence = ''
-        prods = random.sample(self.cfg.productions(lhs=nt), len(self.cfg.productions(lhs=nt)))
-        valid = True
-        for prod in prods:
-            for sym in prod.rhs():
-                if is_nonterminal(sym):
-                    if len(self.cfg.productions(lhs=sym)) < 1:
-                        valid = False
-            if valid == True:
-                for sym in prod.rhs():
-                    if is_nonterminal(sym):
-                        sentence += self.gen_frame_line(sym)
-                    else:
-                        sentence += sym + ' '
-                break
-        if valid == False:
-            return " "  # ERROR
-        else:
-            return sentence  # removed capitalize
-
-
-class Spot:
-
-    def __init__(self, wop, line, column, content):
-        if content == 'POS':
-            self.word = ''
-            self.POS = wop
-            self.line = line
-            self.column = column
-            self.filled = False
-            self.preset = False
-        elif content == 'word':
-            self.word = wop
-            self.POS = ''
-            self.line = line
-            self.column = column
-            self.filled = True
-            self.preset = True
-        else:
-            print(" ")  # spot content error
-
-    def fill(self, word):
-        self.word = word
-        self.filled = True
-
-    def add_POS(self, pos):
-        self.POS = pos
-
-
-class Frame:
-
-    def __init__(self, grammar, tags, length, haiku):
-        self.lines = []
-        repeat_line_array = nltk.word_tokenize(grammar.gen_frame_line(grammar.cfg.start()))
-        if haiku == True:
-            x = 3
-            y = 2
-        elif haiku == False:
-            x = random.randint(0, length)
-            y = random.randint(0, length)
-        for i in range(length):
-            if (i == x or i == y):
-                spot_array = []
-                j = 0
-                noun_set = set(['he', 'she', 'it', 'I'])
-                for wop in repeat_line_array:
-                    if wop in set(tags):
-                        spot = Spot(wop, i, j, 'POS')
-                        if (wop in noun_set):
-                            spot.add_POS('NN')
-                        spot_array.append(spot)
-                    else:
-                        spot = Spot(wop, i, j, 'word')
-                        spot_array.append(spot)
-                    j += 1
-                self.lines.append(spot_array)
-            else:
-                line_array = nltk.word_tokenize(grammar.gen_frame_line(grammar.cfg.start()))
-                spot_array = []
-                j = 0
-                for wop in line_array:
-                    if wop in set(tags):
-                        spot = Spot(wop, i, j, 'POS')
-                        spot_array.append(spot)
-                    else:
-                        spot = Spot(wop, i, j, 'word')
-                        spot_array.append(spot)
-                    j += 1
-                self.lines.append(spot_array)
-
-    def add_collocations(self, text):
-        collocations = text.get_collocations()
-        tagged_collocation_list = []
-        for collocation in collocations:
-            tagged_collocation_list.append(nltk.pos_tag(collocation))
-        for tagged_collocation in tagged_collocation_list:
-            POS_pair = [tagged_collocation[0][1], tagged_collocation[1][1]]
-            word_pair = [tagged_collocation[0][0], tagged_collocation[1][0]]
-        j = 0
-        collocation_used = False
-        for line in self.lines:
-            if collocation_used == False:
-                for i in range(len(line) - 1):  # 0 to line.length-2
-                    if POS_pair == [line[i], line[i + 1]]:
-                        line[i].fill(word_pair[0])
-                        line[i + 1].fill(word_pair[1])
-                        collocation_used = True
-                        break
-                j += 1
-
-    def add_big_words(self, text):
-        fdist = nltk.FreqDist(text.text_array)
-        big_words = []
-        for w in set(text.text_array):
-            if len(w) > 6 and fdist[w] > 2:
-                big_words.append(w)
-        big_words_with_tags = nltk.pos_tag(big_words)
-        big_word_buckets = {}
-        for tag in text.tags:  # initialize list of words for each tag
-            big_word_buckets[tag] = []
-        for big_word_tuple in big_words_with_tags:
-            big_word_buckets[big_word_tuple[1]].append(big_word_tuple[0])
-        used_words = []
-        for line in self.lines:
-            for spot in line:
-                if spot.filled == False and len(big_word_buckets[spot.POS]) > 0:
-                    n = random.randint(0, len(big_word_buckets[spot.POS]) - 1)
-                    big_word = big_word_buckets[spot.POS][n]
-                    if big_word in set(used_words):
-                        pass
-                    else:
-                        spot.fill(big_word)
-                        used_words.append(big_word)
-
-    def repeat_nouns(self, length):
-        noun = ''
-        for spot in self.lines[0]:
-            if spot.POS == 'NN' and spot.filled == True:
-                noun = spot.word
-                break
-        if noun == '': return
-        for i in range(1, length):
-            for spot in self.lines[i]:
-                if spot.POS == 'NN' and spot.filled == False:
-                    spot.fill(noun)
-                    break
-
-    def add_context_words(self, text):
-        for line in self.lines:
-            for spot in line:
-                if spot.filled == True:
-                    if spot.column > 0 and line[spot.column - 1].filled == False and spot.preset == False:
-                        for before_word in text.before[spot.word]:
-                            if line[spot.column - 1].POS == nltk.pos_tag([before_word])[0][1]:
-                                line[spot.column - 1].fill(before_word)
-                                break
-                    if spot.column < len(line) - 1 and line[spot.column + 1].filled == False and spot.preset == False:
-                        for after_word in text.after[spot.word]:
-                            if line[spot.column + 1].POS == nltk.pos_tag([after_word])[0][1]:
-                                line[spot.column + 1].fill(after_word)
-                                break
-
-    def add_random(self, text):
-        while True:
-            x = random.randint(0, 8)
-            y = random.randint(0, len(self.lines[x]))
-            spot = self.lines[x][y]
-            if not spot.filled:
-                n = random.randint(0, len(text.POS_buckets[spot.POS]) - 1)
-                word = text.POS_buckets[spot.POS][n]
-                spot.fill(word)
-                return
+hardware_backend = os.environ.get('POETRY_BOX_HARDWARE', 'arduino')  # 'simulated': in-memory board, typed commands
 
-    def add_first_unfilled(self, text):
-        for line in self.lines:
-            for spot in line:
-                if spot.filled == False:
-                    n = random.randint(0, len(text.POS_buckets[spot.POS]) - 1)
-                    word = text.POS_buckets[spot.POS][n]
-                    spot.fill(word)
-                    break
-
-    def fill_remaining(self, text):
-        for line in self.lines:
-            for spot in line:
-                if not spot.filled:
-                    n = random.randint(0, len(text.POS_buckets[spot.POS]) - 1)
-                    word = text.POS_buckets[spot.POS][n]
-                    spot.fill(word)
-
-    def print(self):
-        for line in self.lines:
-            for spot in line:
-                if spot.filled:
-                    print(spot.word, end=" ")
-                else:
-                    print(spot.POS, end=" ")
-            print()
-        print()
+# servo sequences, played next to whatever the box is doing
+boot_sequence = [('wait', 1),
+                 ('servo', choice_servo_pin, 90), ('servo', type_servo_pin, 90), ('wait', 0.5),
+                 ('servo', type_servo_pin, 0), ('servo', choice_servo_pin, 180), ('wait', 0.5),
+                 ('servo', type_servo_pin, 180), ('servo', choice_servo_pin, 0), ('wait', 0.5),
+                 ('servo', type_servo_pin, 90), ('servo', choice_servo_pin, 90), ('wait', 1)]
+reset_sequence = [('wait', 1), ('servo', choice_servo_pin, 90), ('wait', 1), ('servo', type_servo_pin, 90), ('wait', 1)]
+
+poem_pool = None                            # PoemPool of the running box, see __main__
+poem_database = 'poems.db'                  # SQLite poem store, poems_all.txt is imported into it on first use
+poem_archive = 'poems_all.txt'
+poem_store = None                           # PoemStore, opened on first save or retrieve
+last_poem = None                            # Poem last written to poems_last.txt
+
+
+# board, speech engine and recognizer are created on first use, so importing this module touches no hardware
+class Devices:
+
+    def connect_board():
+        if hardware_backend == 'simulated':
+            board = SimulatedBoard()
+        else:
+            board = ArduinoBoard(baud, port)
+        board.pin_mode(red_led_pin, "OUTPUT")        # REC
+        board.pin_mode(white_led_pin, "OUTPUT")      # Store
+        board.attach_servo(choice_servo_pin)         # servo 1
+        board.attach_servo(type_servo_pin)           # servo 2
+        return board
+
+    def init_engine():
+        if hardware_backend == 'simulated':
+            return SimulatedEngine()
+        engine = pyttsx3.init()
+        voices = engine.getProperty('voices')
+        engine.setProperty('voice', voices[1].id)
+        return engine
+
+
+board = Lazy(Devices.connect_board)
+engine = Lazy(Devices.init_engine)
+listener = Lazy(lambda: sr.Recognizer())
+choreographer = Lazy(lambda: Choreographer(board))
+
+
+# transcribes recording chunks while recording goes on and grows the recorded corpus model as they come in
+class LiveTranscriber:
+
+    def __init__(self, source='recording_audio_temp.txt', recognizer=recognizer_name, workers=transcribe_workers):
+        self.source = source
+        self.recognizer = recognizer
+        self.text = None  # made with the first chunk, NLTK and its tagger load while recording goes on
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+        self.transcriptions = collections.deque()  # in recording order
+        self.lock = threading.Lock()
+        self.transcript = None  # the last recording's transcript stays until the first chunk of this one is in
+
+    def add_chunk(self, pcm):
+        transcription = self.pool.submit(contextvars.copy_context().run, TTS.transcribe_pcm, pcm, self.recognizer)
+        with self.lock:
+            self.transcriptions.append(transcription)
+        transcription.add_done_callback(lambda done: self.commit())
+
+    # chunks can finish out of order, only the finished front of the queue is added
+    def commit(self):
+        with self.lock:
+            while self.transcriptions and self.transcriptions[0].done():
+                chunk_text = self.transcriptions.popleft().result()
+                if self.transcript is None:
+                    self.transcript = open(self.source, 'w+')
+                    self.text = Text('')
+                self.transcript.write(chunk_text + '\n')
+                self.transcript.flush()
+                self.text.extend(chunk_text)
+
+    # waits for the chunks still being transcribed and stores the model like Text.load would, None when nothing
+    # was recorded
+    def finish(self):
+        self.pool.shutdown(wait=True)
+        self.commit()
+        if self.transcript is None:
+            return None
+        self.transcript.close()
+        self.text.compact()
+        with open(self.source, 'rb') as file:
+            ModelCache.save(Text.model_path(self.source), Text.model_key(file.read()), self.text)
+        return self.text
 
 
 # ------------------------------------------- TTS Setup -----------------------------------------------------------
@@ -403,29 +143,52 @@ class Frame:
 class TTS:
 
     def take_command() -> object:
+        command = TTS.hear()
+        if command is None:
+            return 'No voice identified!\n'
+        if wake_word in command:
+            command = command.replace(wake_word, '')
+            print(command + '\n')
+        return command
+
+    # one phrase in lowercase, None when nothing was recognised; typed in when simulated
+    def hear():
+        if hardware_backend == 'simulated':
+            return input('Command: ').lower()
         try:
             with sr.Microphone() as source:
-                command = 'No voice identified!\n'
                 print('Gathering audio input!\n')
-                voice = listener.listen(source) #, phrase_time_limit=10000)  # argument lo litsen a given time
-
-                command = listener.recognize_google(voice)
-                command = command.lower()
+                with metrics.span('wake'):
+                    voice = listener.listen(source) #, phrase_time_limit=10000)  # argument lo litsen a given time
 
-                if 'edgar' in command:
-                    command = command.replace('edgar', '')
-                    print(command + '\n')
-        except:
-            pass
-
-        return command
+                with metrics.span('recognize', recognizer='google'):
+                    return listener.recognize_google(voice).lower()
+        except Exception as e:
+            metrics.count('recognition_failures', stage='command', error=type(e).__name__)
+            return None
 
     def talk(text):
-
-        engine.say(text)
-        engine.runAndWait()
-
-    def record_audio():
+        if speech_interrupted.is_set():
+            return
+        if poem_pool is not None:
+            poem_pool.pause()  # leave the CPU to the speech engine
+        try:
+            with metrics.span('speak'):
+                engine.say(text)
+                engine.runAndWait()
+        finally:
+            if poem_pool is not None:
+                poem_pool.resume()
+
+    # the one engine call made off the speaking thread: stop() has to reach the engine while runAndWait() is
+    # still busy on that thread, queued behind it the stop would only come once the speech is over
+    def stop_speaking():
+        speech_interrupted.set()
+        engine.stop()
+
+    # on_chunk, if given, gets every transcribe_chunk_ms of mono record_rate audio as soon as it is recorded;
+    # recording ends when stop is set, or without a stop event when the stop button reads high
+    def record_audio(on_chunk=None, stop=None):
         chunk = 1024  # Record in chunks of 1024 samples
         sample_format = pyaudio.paInt16  # 16 bits per sample
         channels = 2
@@ -433,74 +196,150 @@ class TTS:
         seconds = 3600  # 1h
         filename = "recording_audio_temp.wav"
 
-        p = pyaudio.PyAudio()  # Create an interface to PortAudio
-
-        print('Recording')
-        board.digitalWrite(red_led_pin, 'HIGH')
-        stream = p.open(format=sample_format,
-                        channels=channels,
-                        rate=fs,
-                        frames_per_buffer=chunk,
-                        input=True)
-
-        frames = []  # Initialize array to store frames
-
-        # Store data in chunks for 3 seconds
-        for i in range(0, int(fs / chunk * seconds)):
-            data = stream.read(chunk)
-            frames.append(data)
-            board.analogRead(button_pin)
-            if board.analogRead(button_pin) > 500:
-                break
-
-        # Stop and close the stream
-        stream.stop_stream()
-        stream.close()
-        # Terminate the PortAudio interface
-        p.terminate()
-
-        board.digitalWrite(red_led_pin, 'LOW')
+        if poem_pool is not None:
+            poem_pool.pause()  # no background generation while recording
+        p = stream = wf = None
+        pcm_chunk = bytearray()
+        try:
+            p = pyaudio.PyAudio()  # Create an interface to PortAudio
+            sample_width = p.get_sample_size(sample_format)
+
+            print('Recording')
+            board.digital_write(red_led_pin, 'HIGH')
+            stream = p.open(format=sample_format,
+                            channels=channels,
+                            rate=fs,
+                            frames_per_buffer=chunk,
+                            input=True)
+
+            # Frames go straight to the WAV file, downmixed and resampled, so memory use does not grow with the
+            # length
+            wf = wave.open(filename, 'wb')
+            wf.setnchannels(1)
+            wf.setsampwidth(sample_width)
+            wf.setframerate(record_rate)
+            resample_state = None
+            chunk_bytes = record_rate * sample_width * transcribe_chunk_ms // 1000
+            for i in range(0, int(fs / chunk * seconds)):
+                data = stream.read(chunk)
+                mono, resample_state = TTS.to_mono(data, fs, resample_state)
+                wf.writeframesraw(mono)
+                if on_chunk is not None:
+                    pcm_chunk += mono
+                    if len(pcm_chunk) >= chunk_bytes:
+                        on_chunk(bytes(pcm_chunk))
+                        pcm_chunk = bytearray()
+                if stop is not None:
+                    if stop.is_set():
+                        break
+                else:
+                    board.analog_read(button_pin)
+                    if board.analog_read(button_pin) > 500:
+                        break
+        finally:
+            # only what was opened before a failure, e.g. a busy or missing input device
+            if wf is not None:
+                wf.close()  # patches the header with the final length
+            if on_chunk is not None and pcm_chunk:
+                on_chunk(bytes(pcm_chunk))
+            if stream is not None:
+                # Stop and close the stream
+                stream.stop_stream()
+                stream.close()
+            if p is not None:
+                # Terminate the PortAudio interface
+                p.terminate()
+
+            board.digital_write(red_led_pin, 'LOW')
+            if poem_pool is not None:
+                poem_pool.resume()
         print('Finished recording')
 
-        # Save the recorded data as a WAV file
-        wf = wave.open(filename, 'wb')
-        wf.setnchannels(channels)
-        wf.setsampwidth(p.get_sample_size(sample_format))
-        wf.setframerate(fs)
-        wf.writeframes(b''.join(frames))
-        wf.close()
-
         print('Recording saved to file\n')
 
-    def audio_file_chunks():
-        source_audio = AudioSegment.from_file("recording_audio_temp.wav", "wav")
-        chunk_length_ms = 10000
-        chunks = make_chunks(source_audio, chunk_length_ms)
-        for i, chunk in enumerate(chunks):
-            chunk_name = "chunk{0}.wav".format(i)
-            print("exporting", chunk_name)
-            chunk.export(chunk_name, format="wav")
-        i = 0
-        with open('recording_audio_temp.txt', 'w+') as recording_temp:
-            sys.stdout = recording_temp
-            for chunk in chunks:
-                chunk_silent = AudioSegment.silent(duration=10)
-                audio_chunk = chunk_silent + chunk + chunk_silent
-                audio_chunk.export("./chunk{0}.wav".format(i), bitrate='192k', format="wav")
-                filename = 'chunk' + str(i) + '.wav'
-                file = filename
-                r = sr.Recognizer()
-                with sr.AudioFile(file) as source:
-                    audio = r.listen(source)
-                try:
-                    print(r.recognize_google(audio))
-                except sr.UnknownValueError:
-                    print(" ")
-                except sr.RequestError as e:
-                    print(" ".format(e))
-                i += 1
-        recording_temp.close()
-        print('Exporting done')
+    # 16 bit stereo frames at rate to mono record_rate samples, interpolated between neighbouring frames; state
+    # carries the read position and the last frame from one chunk to the next
+    def to_mono(data, rate, state=None):
+        samples = array.array('h', data)
+        mono = [(left + right) // 2 for left, right in zip(samples[0::2], samples[1::2])]
+        position, previous = state if state is not None else (1.0, 0)
+        frames = [previous] + mono  # frames[0] is the last frame of the previous chunk
+        step = rate / record_rate
+        resampled = array.array('h')
+        while position < len(frames) - 1:
+            i = int(position)
+            resampled.append(int(frames[i] + (frames[i + 1] - frames[i]) * (position - i)))
+            position += step
+        return resampled.tobytes(), (position - len(mono), frames[-1])
+
+    # raw mono record_rate 16 bit audio, padded with 10 ms of silence on both sides
+    def transcribe_pcm(pcm, recognizer=recognizer_name):
+        silence = bytes(record_rate * 2 // 100)
+        wav = io.BytesIO()
+        wf = wave.open(wav, 'wb')
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(record_rate)
+        wf.writeframes(silence + pcm + silence)
+        wf.close()
+        wav.seek(0)
+        return TTS.transcribe(wav, recognizer)
+
+    # WAV file or buffer to text, ' ' when nothing was recognised; recognizer is a recognize_<name>
+    # method name of speech_recognition, 'local' or any callable taking an sr.AudioData
+    def transcribe(wav, recognizer=recognizer_name):
+        r = sr.Recognizer()
+        with sr.AudioFile(wav) as source:
+            audio = r.record(source)  # the whole chunk, listen() would stop at its first pause
+        name = getattr(recognizer, '__name__', recognizer)
+        try:
+            with metrics.span('recognize', recognizer=name):
+                if callable(recognizer):
+                    return recognizer(audio)
+                if recognizer == 'local':
+                    return TTS.recognize_local(audio)
+                return getattr(r, 'recognize_' + recognizer)(audio)
+        except sr.UnknownValueError:
+            metrics.count('recognition_failures', stage='recording', error='UnknownValueError')
+            return " "
+        except (sr.RequestError, OSError) as e:
+            metrics.count('recognition_failures', stage='recording', error=type(e).__name__)
+            print('Recognition failed: {}\n'.format(e))
+            return " "
+
+    # offline recognizer or test stub listening on local_recognizer_url
+    def recognize_local(audio):
+        request = urllib.request.Request(local_recognizer_url, data=audio.get_wav_data(),
+                                         headers={'Content-Type': 'audio/wav'})
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.read().decode('utf-8').strip() or " "
+
+    # speak lines while they are still being produced: a thread runs the generator, each line is spoken
+    # as soon as it arrives
+    def read_poem_lines(lines):
+        ready_lines = queue.Queue()
+        errors = []
+
+        def produce():
+            try:
+                for line in lines:
+                    ready_lines.put(line)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                ready_lines.put(None)
+
+        threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True).start()
+        engine.setProperty('rate', poetry_voice_rate)  # slow down voice for poetry reading
+        try:
+            line = ready_lines.get()
+            while line is not None and not speech_interrupted.is_set():
+                TTS.talk(line)
+                line = ready_lines.get()
+        finally:
+            engine.setProperty('rate', normal_voice_rate)  # back to normal voice rate
+        if errors:
+            raise errors[0]
 
     def read_last_poem():
 
@@ -520,179 +359,434 @@ class TTS:
 # ----------------------------------------------------------- Functions Declaration -----------------------------------------------------------
 
 
+# saved poems in SQLite: integer ids give O(1) random picks, source / form / date are indexed for searching
+class PoemStore:
+
+    def __init__(self, path=poem_database, archive=poem_archive):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS poems (id INTEGER PRIMARY KEY, created TEXT, '
+                                    'source TEXT, form TEXT, text TEXT NOT NULL)')
+            for column in ('created', 'source', 'form'):
+                self.connection.execute('CREATE INDEX IF NOT EXISTS poems_{0} ON poems ({0})'.format(column))
+        if self.count() == 0 and os.path.exists(archive):
+            self.import_archive(archive)
+
+    # poems_all.txt format: every poem starts with a **#** line
+    def import_archive(self, archive):
+        with open(archive, 'r') as file:
+            poems = [poem.strip('\r\n') for poem in file.read().replace('\r', '').split('**#**')]
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT INTO poems (text) VALUES (?)',
+                                        [(poem + '\n',) for poem in poems if poem.strip()])
+
+    def add(self, text, source=None, form=None, created=None):
+        created = created or time.strftime('%Y-%m-%d %H:%M:%S')
+        with self.lock, self.connection:  # committed before returning
+            cursor = self.connection.execute('INSERT INTO poems (created, source, form, text) VALUES (?, ?, ?, ?)',
+                                             (created, source, form, text))
+        return cursor.lastrowid
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM poems').fetchone()[0]
+
+    def get(self, poem_id):
+        with self.lock:
+            row = self.connection.execute('SELECT text FROM poems WHERE id = ?', (poem_id,)).fetchone()
+        return row[0] if row else None
+
+    # ids are only ever appended, so a random id in range is nearly always a hit
+    def random(self):
+        with self.lock:
+            low, high = self.connection.execute('SELECT MIN(id), MAX(id) FROM poems').fetchone()
+        if high is None:
+            return None
+        while True:
+            poem = self.get(random.randint(low, high))
+            if poem is not None:
+                return poem
+
+    # dates as 'YYYY-MM-DD[ HH:MM:SS]', since inclusive and until exclusive
+    def search(self, source=None, form=None, since=None, until=None):
+        conditions, values = [], []
+        for condition, value in (('source = ?', source), ('form = ?', form),
+                                 ('created >= ?', since), ('created < ?', until)):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        query = 'SELECT text FROM poems'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self.lock:
+            return [row[0] for row in self.connection.execute(query + ' ORDER BY id', values)]
+
+
 class Functions:
 
+    # the whole source cleaned as one string, Text.clean_chunks gives it chunk by chunk
     def clean_source_text(source):
-        file = open(source, 'r+', encoding='utf-8')
-        text = file.read()
-        text = re.sub('[0-9]+', '', str(text))
-        text = re.sub('\n ', '', str(text))
-        text = re.sub('\n', ' ', str(text))
-        text = re.sub('_', '', str(text))
-        text = re.sub(':', '', str(text))
-        text = re.sub("'s", '', str(text))
-        text = re.sub("-", ' ', str(text))
-        text = re.sub("— ", '', str(text))
-        text = re.sub('\"', '', str(text))
-        text = re.split('[.?!]', text)
-        clean_sent = []
-        for sent in text:
-            clean_sent.append(sent)
-        separator = ' '
-        clean_text = separator.join(clean_sent)
-        return clean_text
-
-    def run_generator(source, length, haiku):
-        file = open(source, 'r+', encoding='utf-8')
-        read_source = file.read()
-        text = Text(read_source)  # seperates words into POS buckets
-        grammar = Grammar(haiku)  # makes CFG
-        frame = Frame(grammar, text.tags, length, haiku)  # create "frame" of poem: list of lists of POS tags
-        frame.add_collocations(text)
-        frame.add_big_words(text)
-        frame.repeat_nouns(length)
-        for x in range(3):
-            frame.add_context_words(text)
-        frame.add_first_unfilled(text)
-        frame.repeat_nouns(length)
-        frame.add_context_words(text)
-        frame.fill_remaining(text)
+        with open(source, encoding='utf-8') as file:
+            return ''.join(Text.clean_chunks(file))
+
+    def run_generator(source, length, haiku, registry=None, form=None):
+        lines = list(Functions.stream_generator(source, length, haiku, registry, form))
+        return Poem(lines, source, length, haiku, form)
+
+    # yields the poem line by line while it is being generated, poems_last.txt is written once it is complete
+    def stream_generator(source, length, haiku, registry=None, form=None):
+        if registry is not None:
+            text = registry.get(source)  # already warm in memory
+        else:
+            text = Text.load(source)  # seperates words into POS buckets, cached per source
+        lines = []
+        for line in Generator.generate_lines(text, length, haiku, form):
+            lines.append(line)
+            yield line
+        Functions.write_last_poem(Poem(lines, source, length, haiku, form))
+
+    def write_last_poem(poem):
+        global last_poem
         with open('poems_last.txt', 'w+') as file_last_poem:
-            sys.stdout = file_last_poem
-            frame.print()
-        file_last_poem.close()
+            file_last_poem.write(poem.text())
+        last_poem = poem
 
+    def open_poem_store():
+        global poem_store
+        if poem_store is None:
+            poem_store = PoemStore()
+        return poem_store
 
     def save_poem_database():
-        board.digitalWrite(white_led_pin, "HIGH")
-        time.sleep(2)
-        poem_database = open('poems_all.txt', 'a+')
-        with open('poems_last.txt', 'r+') as file_last_poem:
-            last_poem_temp = file_last_poem.readlines()
-            poem_database.write('**#**\n')
-            for line in last_poem_temp:
-                poem_database.write(line)
-        file_last_poem.close()
-        poem_database.write('\r\n')
-        poem_database.close()
+        choreographer.play([('led', white_led_pin, "HIGH")])
+        with open('poems_last.txt', 'r') as file_last_poem:
+            poem_text = file_last_poem.read()
+        if last_poem is not None and last_poem.text() == poem_text:
+            Functions.open_poem_store().add(poem_text, last_poem.source, last_poem.form, last_poem.created)
+        else:
+            Functions.open_poem_store().add(poem_text)  # written by an older run, nothing known about it
         print('Poem stored!\n')
-        time.sleep(2)
-        board.digitalWrite(white_led_pin, "LOW")
+        choreographer.play([('wait', 2), ('led', white_led_pin, "LOW")])  # keep the LED on long enough to be seen
 
 
     def retrieve_from_database():
-        with open('poems_all.txt', "r") as fh:
-            raw_text = fh.read()
-            raw_text2 = raw_text.replace('\n', '')
-            text_split = raw_text2.split('**#**')
-            text_split.remove('')
-            poem = random.choice(tuple(text_split))
-            print(poem)
-            engine.setProperty('rate', poetry_voice_rate)  # skip empty character item
-            TTS.talk(poem)
-            engine.setProperty('rate', normal_voice_rate)
-
-
-    def run_edgar():
-        command = TTS.take_command()  # take audio input
+        poem = Functions.open_poem_store().random()
+        if poem is None:
+            return
+        print(poem)
+        engine.setProperty('rate', poetry_voice_rate)  # slow down voice for poetry reading
+        TTS.talk(poem.replace('\n', ' '))
+        engine.setProperty('rate', normal_voice_rate)
+
+
+    # command is only given when driving the box without a microphone, e.g. in the simulator
+    def run_edgar(registry=None, command=None):
+        metrics.trace()  # wake and recognize belong to the trace of the command they bring
+        if command is None:
+            command = TTS.take_command()  # take audio input
         if command != ('No voice identified!\n'):
 
-            time.sleep(1)
-            board.Servos.write(choice_servo_pin, 90)  # boot sequence
-            board.Servos.write(type_servo_pin, 90)  # boot sequence
-            time.sleep(0.5)
-            board.Servos.write(type_servo_pin, 0)
-            board.Servos.write(choice_servo_pin, 180)
-            time.sleep(0.5)
-            board.Servos.write(type_servo_pin, 180)
-            board.Servos.write(choice_servo_pin, 0)
-            time.sleep(0.5)
-            board.Servos.write(type_servo_pin, 90)  # boot sequence
-            board.Servos.write(choice_servo_pin, 90)  # boot sequence
-            time.sleep(1)
+            with metrics.span('command', command=Functions.command_kind(command)):
+                choreographer.play(boot_sequence)  # runs while the command is handled
+
+                if 'listen' in command:
+                    Functions.record_corpus(registry)
+
+                elif 'read' in command:
+                    TTS.read_last_poem()
+
+                elif 'save' in command:
+                    Functions.save_poem_database()
 
+                elif 'retrieve' in command:
+                    Functions.retrieve_from_database()
+
+                elif 'generate' in command:
+                    source, length, haiku, form = Functions.select_poem(command)
+                    TTS.read_poem_lines(Functions.poem_lines(source, length, haiku, registry, form))
+                else:
+                    TTS.talk('I was not able to understand the command.\n')
+                    print('I was not able to understand the command.\n')
+
+                choreographer.play(reset_sequence)
+
+    # first of command_kinds asked for, used to label the command spans
+    def command_kind(command):
+        for kind in command_kinds:
+            if kind in command:
+                return kind
+        return 'unknown'
+
+    def record_corpus(registry=None, stop=None):
+        choreographer.wait()  # keep the servos out of the recording
+        if stop is not None and stop.is_set():
+            return  # stopped or interrupted during the boot animation, the last recording stays
+        live = LiveTranscriber()  # transcribes and tags while recording
+        with metrics.span('record'):
+            TTS.record_audio(live.add_chunk, stop)
+        recorded = live.finish()
+        if registry is not None and recorded is not None:
+            registry.put(live.source, recorded)
+
+    # source, length, haiku and form asked for in a generate command, shown on the servos
+    def select_poem(command):
+        choreographer.play([('wait', 1)])
+        blends = [name for name in corpus_blends if name in command]  # e.g. 'generate a blended poem'
+        if blends:
+            source = blends[0]
+            print('Text Source: ' + ' + '.join('{} {}'.format(part, weight) for part, weight in corpus_blends[source])
+                  + '\n')
+            choreographer.play([('servo', choice_servo_pin, 45), ('wait', 1)])
+        elif 'shakespeare' in command:
+            source = 'shakespeare.txt'
+            print('Text Source: Shakespeare\n')
+            choreographer.play([('servo', choice_servo_pin, 160), ('wait', 1)])
+        elif 'bible' in command:
+            source = 'bible.txt'
+            print('Text Source: The Bible\n')
+            choreographer.play([('servo', choice_servo_pin, 70), ('wait', 1)])
+        elif 'recorded' in command:
+            source = 'recording_audio_temp.txt'
+            print('Text Source: Audio Recording\n')
+            choreographer.play([('servo', choice_servo_pin, 20), ('wait', 1)])
+        else:
+            source = 'poe_all.txt'
+            print('Text Source: Edgar AlLan Poe\n')
+            choreographer.play([('servo', choice_servo_pin, 110), ('wait', 1)])
+
+        if 'haiku' in command:
+            haiku = True
+            length = 3
+            print('Poetry type: haiku\n')
+            choreographer.play([('servo', type_servo_pin, 20), ('wait', 1)])
+
+        elif 'short' in command:
+            haiku = False
+            length = 4
+            print('Poetry type: Free Form\n')
+            print('Poetry length: Short\n')
+            choreographer.play([('servo', type_servo_pin, 70), ('wait', 1)])
+
+        elif 'long' in command:
+            haiku = False
+            length = 12
+            print('Poetry type: Free Form\n')
+            print('Poetry length: Long\n')
+            choreographer.play([('servo', type_servo_pin, 160), ('wait', 1)])
+        else:
+            haiku = False
+            length = 8
+            print('Poetry type: Free Form\n')
+            print('Poetry length: Medium\n')
+            choreographer.play([('servo', type_servo_pin, 110), ('wait', 1)])
+
+        form = None
+        for name in Grammar.forms():  # extra poem forms dropped into grammars/
+            if name not in ('haiku', 'free_form') and name.replace('_', ' ') in command:
+                form = name
+                print('Poetry form: ' + name + '\n')
+        return source, length, haiku, form
+
+    # lines of a pooled poem when one is ready, otherwise of a poem generated while it is read
+    def poem_lines(source, length, haiku, registry=None, form=None):
+        poem = None
+        if poem_pool is not None and form is None:
+            poem = poem_pool.take(source, length, haiku)  # pre-generated while idle
+        if poem is None:
+            return Functions.stream_generator(source, length, haiku, registry, form)
+        Functions.write_last_poem(poem)
+        return iter(poem.lines)
+
+    def last_poem_lines():
+        with open('poems_last.txt') as poems_last:
+            return [line.rstrip() for line in poems_last if line.strip()]
+
+
+# ------------------------------------------ Async Runtime ----------------------------------------------------------
+
+# the box as cooperating asyncio tasks: the listener feeds commands to the dispatcher, poems flow line by line from
+# the generator to the speaker, the stop button is polled on its own; blocking libraries run in executors
+class Runtime:
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.commands = asyncio.Queue()
+        self.microphone = concurrent.futures.ThreadPoolExecutor(1)  # listening for the next command
+        self.voice = concurrent.futures.ThreadPoolExecutor(1)       # pyttsx3 is driven from one thread only
+        self.hardware = concurrent.futures.ThreadPoolExecutor(1)    # stop button reads
+        self.blocking = concurrent.futures.ThreadPoolExecutor(2)    # generation, recording, database
+        self.current = None                                         # task handling the current command
+        self.recording = False
+        self.stop_recording = threading.Event()
+        self.microphone_free = asyncio.Event()                     # the listener waits while a recording runs
+        self.microphone_free.set()
+
+    # run_in_executor without losing the open span, blocking work shows up in the trace of its command
+    def in_executor(self, executor, function, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(executor, contextvars.copy_context().run, function, *args)
+
+    # runs until there are no more commands, e.g. the end of typed input, and the last one is done
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.voice, engine.get)  # create the engine on the thread that speaks
+        workers = [asyncio.ensure_future(self.dispatch()), asyncio.ensure_future(self.poll_button())]
+        try:
+            await self.listen()
+            await self.commands.join()
+            if self.current is not None:
+                await asyncio.gather(self.current, return_exceptions=True)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    def busy(self):
+        return self.current is not None and not self.current.done()
+
+    async def listen(self):
+        loop = asyncio.get_running_loop()
+        booted = False
+        while True:
+            await self.microphone_free.wait()
+            if not booted:
+                Runtime.report_boot()  # the engine is up and the microphone is about to open
+                booted = True
+            context = contextvars.copy_context()  # one trace from listening to the end of the command
+            context.run(metrics.trace)
+            try:
+                phrase = await loop.run_in_executor(self.microphone, context.run, TTS.hear)
+            except EOFError:
+                print('No more commands\n')
+                return
+            if phrase is None:
+                continue
+            if self.busy() and hardware_backend != 'simulated' and wake_word not in phrase:
+                metrics.count('ignored_phrases')  # most likely the box hearing its own voice
+                continue
+            command = phrase.replace(wake_word, '')
+            if Functions.command_kind(command) == 'listen':
+                self.microphone_free.clear()  # the recording takes the microphone, not the next listen
+            await self.commands.put((command, context))
+
+    # cold start, from the first line of this module to listening for the first command
+    def report_boot():
+        boot_time = time.perf_counter() - boot_started
+        print('Ready in {:.2f}s\n'.format(boot_time))
+        metrics.observe('boot', boot_time)
+        if boot_time > cold_start_budget:
+            print('Cold start over budget: {:.2f}s > {:.2f}s\n'.format(boot_time, cold_start_budget))
+
+    # a new command cuts short whatever the box is still saying or generating
+    async def dispatch(self):
+        while True:
+            command, context = await self.commands.get()
+            await self.interrupt()
+            speech_interrupted.clear()
+            self.current = context.run(asyncio.ensure_future, self.handle(command))  # the task runs in a copy
+            self.commands.task_done()
+
+    async def interrupt(self):
+        if self.busy():
+            TTS.stop_speaking()
+            self.stop_recording.set()  # a cancelled recording has to let go of the microphone too
+            choreographer.clear()  # its servo and LED steps would play on under the next command
+            self.current.cancel()  # which queues the reset sequence
+            try:
+                await self.current
+            except asyncio.CancelledError:
+                pass
+
+    async def poll_button(self):
+        loop = asyncio.get_running_loop()
+        pressed = False
+        while True:
+            value = await loop.run_in_executor(self.hardware, board.analog_read, button_pin)
+            if value > 500 and not pressed:
+                if self.recording:
+                    self.stop_recording.set()
+                else:
+                    await self.interrupt()
+            pressed = value > 500
+            await asyncio.sleep(button_poll_interval)
+
+    async def handle(self, command):
+        with metrics.span('command', command=Functions.command_kind(command)):
+            await self.handle_command(command)
+
+    async def handle_command(self, command):
+        choreographer.play(boot_sequence)
+        try:
             if 'listen' in command:
-                TTS.record_audio()
-                TTS.audio_file_chunks()
+                self.recording = True
+                self.stop_recording.clear()
+                self.microphone_free.clear()
+                recording = self.in_executor(self.blocking, Functions.record_corpus, self.registry,
+                                             self.stop_recording)
+                try:
+                    await asyncio.shield(recording)
+                except asyncio.CancelledError:
+                    self.stop_recording.set()
+                    await asyncio.gather(recording, return_exceptions=True)  # until the microphone is closed
+                    raise
+                finally:
+                    self.recording = False
+                    self.microphone_free.set()
 
             elif 'read' in command:
-                TTS.read_last_poem()
+                await self.speak_lines(iter(Functions.last_poem_lines()))
 
             elif 'save' in command:
-                Functions.save_poem_database()
+                await self.in_executor(self.blocking, Functions.save_poem_database)
 
             elif 'retrieve' in command:
-                Functions.retrieve_from_database()
+                await self.in_executor(self.voice, Functions.retrieve_from_database)
 
             elif 'generate' in command:
-                time.sleep(1)
-                if 'shakespeare' in command:
-                    source = 'shakespeare.txt'
-                    print('Text Source: Shakespeare\n')
-                    board.Servos.write(choice_servo_pin, 160)
-                    time.sleep(1)
-                elif 'bible' in command:
-                    source = 'bible.txt'
-                    print('Text Source: The Bible\n')
-                    board.Servos.write(choice_servo_pin, 70)
-                    time.sleep(1)
-                elif 'recorded' in command:
-                    source = 'recording_audio_temp.txt'
-                    print('Text Source: Audio Recording\n')
-                    board.Servos.write(choice_servo_pin, 20)
-                    time.sleep(1)
-                else:
-                    source = 'poe_all.txt'
-                    print('Text Source: Edgar AlLan Poe\n')
-                    board.Servos.write(choice_servo_pin, 110)
-                    time.sleep(1)
-
-                if 'haiku' in command:
-                    haiku = True
-                    length = 3
-                    print('Poetry type: haiku\n')
-                    board.Servos.write(type_servo_pin, 20)
-                    time.sleep(1)
-
-                elif 'short' in command:
-                    haiku = False
-                    length = 4
-                    print('Poetry type: Free Form\n')
-                    print('Poetry length: Short\n')
-                    board.Servos.write(type_servo_pin, 70)
-                    time.sleep(1)
-
-                elif 'long' in command:
-                    haiku = False
-                    length = 12
-                    print('Poetry type: Free Form\n')
-                    print('Poetry length: Long\n')
-                    board.Servos.write(type_servo_pin, 160)
-                    time.sleep(1)
-                else:
-                    haiku = False
-                    length = 8
-                    print('Poetry type: Free Form\n')
-                    print('Poetry length: Medium\n')
-                    board.Servos.write(type_servo_pin, 110)
-                    time.sleep(1)
-
-                Functions.run_generator(source, length, haiku)
-                TTS.read_last_poem()
+                source, length, haiku, form = Functions.select_poem(command)
+                lines = await self.in_executor(self.blocking, Functions.poem_lines, source, length, haiku,
+                                               self.registry, form)
+                await self.speak_lines(lines)
             else:
-                TTS.talk('I was not able to understand the command.\n')
                 print('I was not able to understand the command.\n')
-
-            time.sleep(1)
-            board.Servos.write(choice_servo_pin, 90)
-            time.sleep(1)
-            board.Servos.write(type_servo_pin, 90)
-            time.sleep(1)
-
+                await self.in_executor(self.voice, TTS.talk, 'I was not able to understand the command.\n')
+        finally:
+            choreographer.play(reset_sequence)
+
+    # lines is advanced in an executor, each line is spoken as soon as it is ready while the next one is made
+    async def speak_lines(self, lines):
+        loop = asyncio.get_running_loop()
+        ready_lines = asyncio.Queue()
+
+        async def produce():
+            while True:
+                line = await self.in_executor(self.blocking, next, lines, None)
+                await ready_lines.put(line)
+                if line is None:
+                    return
+
+        producer = asyncio.ensure_future(produce())
+        # slow down voice for poetry reading
+        await loop.run_in_executor(self.voice, engine.setProperty, 'rate', poetry_voice_rate)
+        try:
+            line = await ready_lines.get()
+            while line is not None:
+                await self.in_executor(self.voice, TTS.talk, line)
+                line = await ready_lines.get()
+            await producer
+        finally:
+            producer.cancel()
+            self.voice.submit(engine.setProperty, 'rate', normal_voice_rate)  # back to normal voice rate
 
 
 # ------------------------------------- Generator Main run -----------------------------------------------------------
 
 if __name__ == "__main__":
-    while True:
-        Functions.run_edgar()
\ No newline at end of file
+    registry = CorpusRegistry(corpus_sources)  # starts loading every source in the background
+    poem_pool = PoemPool(registry, corpus_sources)  # keeps ready made poems for every servo setting
+    if metrics_log:
+        metrics.log_to(metrics_log)
+    if metrics_port:
+        metrics.serve(metrics_port)
+    asyncio.run(Runtime(registry).run())